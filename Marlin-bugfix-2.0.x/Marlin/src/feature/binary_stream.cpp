@@ -29,7 +29,7 @@
 
 char* SDFileTransferProtocol::Packet::Open::data = nullptr;
 size_t SDFileTransferProtocol::data_waiting, SDFileTransferProtocol::transfer_timeout, SDFileTransferProtocol::idle_timeout;
-bool SDFileTransferProtocol::transfer_active, SDFileTransferProtocol::dummy_transfer, SDFileTransferProtocol::compression;
+bool SDFileTransferProtocol::transfer_active, SDFileTransferProtocol::dummy_transfer, SDFileTransferProtocol::compression, SDFileTransferProtocol::resumable;
 
 BinaryStream binaryStream[NUM_SERIAL];
 
@@ -44,7 +44,8 @@ private:
   struct Packet {
     struct [[gnu::packed]] Open {
       static bool validate(char *buffer, size_t length) {
-        return (length > sizeof(Open) && buffer[length - 1] == '\0');
+        // A resumed transfer carries a 32-bit file offset ahead of the filename
+        return (length > sizeof(Open) + ((buffer[0] & 0x2) ? 4 : 0) && buffer[length - 1] == '\0');
       }
       static Open& decode(char *buffer) {
         data = &buffer[2];
@@ -52,17 +53,23 @@ private:
       }
       bool compression_enabled() { return compression & 0x1; }
       bool dummy_transfer() { return dummy & 0x1; }
-      static char* filename() { return data; }
+      bool resume_transfer() { return dummy & 0x2; }
+      uint32_t offset() {
+        if (!resume_transfer()) return 0;
+        const uint8_t *o = reinterpret_cast<uint8_t*>(data);
+        return uint32_t(o[0]) | (uint32_t(o[1]) << 8) | (uint32_t(o[2]) << 16) | (uint32_t(o[3]) << 24);
+      }
+      char* filename() { return resume_transfer() ? &data[4] : data; }
       private:
         uint8_t dummy, compression;
         static char* data;  // variable length strings complicate things
     };
   };
 
-  static bool file_open(char *filename) {
+  static bool file_open(char *filename, const int32_t resume_at=-1) {
     if (!dummy_transfer) {
       card.mount();
-      card.openFileWrite(filename);
+      card.openFileWrite(filename, resume_at);
       if (!card.isFileOpen()) return false;
     }
     transfer_active = true;
@@ -129,7 +136,7 @@ private:
   enum class FileTransfer : uint8_t { QUERY, OPEN, CLOSE, WRITE, ABORT };
 
   static size_t data_waiting, transfer_timeout, idle_timeout;
-  static bool transfer_active, dummy_transfer, compression;
+  static bool transfer_active, dummy_transfer, compression, resumable;
 
 public:
 
@@ -138,7 +145,8 @@ public:
     const millis_t ms = millis();
     if (transfer_active && ELAPSED(ms, idle_timeout)) {
       idle_timeout = ms + IDLE_PERIOD;
-      if (ELAPSED(ms, transfer_timeout)) transfer_abort();
+      // Keep the partial file of a resumable transfer so the host can continue it
+      if (ELAPSED(ms, transfer_timeout)) { if (resumable) file_close(); else transfer_abort(); }
     }
   }
 
@@ -161,7 +169,8 @@ public:
             auto packet = Packet::Open::decode(buffer);
             compression = packet.compression_enabled();
             dummy_transfer = packet.dummy_transfer();
-            if (file_open(packet.filename())) {
+            resumable = packet.resume_transfer();
+            if (file_open(packet.filename(), resumable ? int32_t(packet.offset()) : -1)) {
               SERIAL_ECHOLNPGM("PFT:success");
               break;
             }
@@ -194,7 +203,7 @@ public:
     }
   }
 
-  static const uint16_t VERSION_MAJOR = 0, VERSION_MINOR = 1, VERSION_PATCH = 0, TIMEOUT = 10000, IDLE_PERIOD = 1000;
+  static const uint16_t VERSION_MAJOR = 0, VERSION_MINOR = 2, VERSION_PATCH = 0, TIMEOUT = 10000, IDLE_PERIOD = 1000;
 };
 
 class BinaryStream {
@@ -701,8 +701,9 @@ inline void echo_write_to_file(const char * const fname) {
 
 //
 // Open a file by DOS path for write
+// With resume_at >= 0 keep the existing file, cut it to that length and append
 //
-void CardReader::openFileWrite(const char * const path) {
+void CardReader::openFileWrite(const char * const path, const int32_t resume_at/*=-1*/) {
   if (!isMounted()) return;
 
   announceOpen(2, path);
@@ -717,7 +718,13 @@ void CardReader::openFileWrite(const char * const path) {
   #if ENABLED(SDCARD_READONLY)
     openFailed(fname);
   #else
-    if (file.open(diveDir, fname, O_CREAT | O_APPEND | O_WRITE | O_TRUNC)) {
+    const bool resume = resume_at >= 0;
+    if (file.open(diveDir, fname, O_CREAT | O_APPEND | O_WRITE | (resume ? 0 : O_TRUNC))) {
+      if (resume && (uint32_t(resume_at) > file.fileSize() || !file.truncate(resume_at))) {
+        file.close();
+        openFailed(fname);
+        return;
+      }
       flag.saving = true;
       selectFileByName(fname);
       TERN_(EMERGENCY_PARSER, emergency_parser.disable());
@@ -136,7 +136,7 @@ public:
 
   // Basic file ops
   static void openFileRead(const char * const path, const uint8_t subcall=0);
-  static void openFileWrite(const char * const path);
+  static void openFileWrite(const char * const path, const int32_t resume_at=-1);
   static void closefile(const bool store_location=false);
   static bool fileExists(const char * const name);
   static void removeFile(const char * const name);
@@ -209,24 +209,74 @@ if pioutil.is_pio_build():
         env['MARLIN_FEATURES'] = marlin_features
 
     #
-    # Return True if a matching feature is enabled
+    # Answer feature queries on MARLIN_FEATURES without rescanning it.
+    # Plain names are looked up directly, the names matching a pattern
+    # are found once per pattern, and the state of each define is
+    # resolved once through the chain of defines it refers to.
     #
-    def MarlinHas(env, feature):
-        load_marlin_features()
-        r = re.compile('^' + feature + '$')
-        found = list(filter(r.match, env['MARLIN_FEATURES']))
-
-        # Defines could still be 'false' or '0', so check
-        some_on = False
-        if len(found):
-            for f in found:
-                val = env['MARLIN_FEATURES'][f]
+    class FeatureIndex:
+
+        def __init__(self, features):
+            self.features = features
+            self.matches = {}   # pattern -> matching define names
+            self.state = {}     # define name -> True / False, or None for any other value
+
+        def find(self, feature):
+            if feature not in self.matches:
+                if re.fullmatch(r'\w+', feature):
+                    found = [ feature ] if feature in self.features else []
+                else:
+                    r = re.compile('^' + feature + '$')
+                    found = list(filter(r.match, self.features))
+                self.matches[feature] = found
+            return self.matches[feature]
+
+        # Find the defines for all the patterns in one pass over the defines
+        def find_all(self, patterns):
+            patterns = [ p for p in set(patterns) if p not in self.matches and not re.fullmatch(r'\w+', p) ]
+            if not patterns: return
+            regexes = [ (p, re.compile('^' + p + '$')) for p in patterns ]
+            for p in patterns: self.matches[p] = []
+            for name in self.features:
+                for p, r in regexes:
+                    if r.match(name): self.matches[p].append(name)
+
+        def define_state(self, name):
+            if name not in self.state:
+                self.state[name] = False    # A define that refers back to itself is off
+                val = self.features[name]
                 if val in [ '', '1', 'true' ]:
-                    some_on = True
-                elif val in env['MARLIN_FEATURES']:
-                    some_on = env.MarlinHas(val)
+                    self.state[name] = True
+                elif val in self.features:
+                    self.state[name] = self.has(val)
+                else:
+                    self.state[name] = None
+            return self.state[name]
+
+        def has(self, feature):
+            # Defines could still be 'false' or '0', so check
+            some_on = False
+            for f in self.find(feature):
+                state = self.define_state(f)
+                if state is not None:
+                    some_on = state
+            return some_on
+
+    feature_index = None
+
+    def get_feature_index():
+        global feature_index
+        load_marlin_features()
+        if feature_index is None or feature_index.features is not env['MARLIN_FEATURES']:
+            feature_index = FeatureIndex(env['MARLIN_FEATURES'])
+            feature_index.find_all(FEATURE_CONFIG)
+        return feature_index
 
-        return some_on
+    #
+    # Return True if a matching feature is enabled
+    #
+    def MarlinHas(env, feature):
+        return get_feature_index().has(feature)
 
     validate_pio()
 
@@ -243,10 +293,12 @@ if pioutil.is_pio_build():
     #
     # Add dependencies for enabled Marlin features
     #
-    apply_features_config()
-    force_ignore_unused_libs()
+    with pioutil.timing('features', env, 'common-dependencies.py'):
+        apply_features_config()
+        force_ignore_unused_libs()
 
     #print(env.Dump())
 
     from signature import compute_build_signature
-    compute_build_signature(env)
+    with pioutil.timing('signature', env, 'signature.py'):
+        compute_build_signature(env)
@@ -0,0 +1,171 @@
+#
+# config_headers.py
+# A parsed model of the Configuration headers, shared by configuration.py,
+# signature.py, schema.py and mc-apply.py so each file is read and indexed once.
+#
+import re, os, bisect, shutil
+from pathlib import Path
+
+CONFIG_FILES = ('Configuration.h', 'Configuration_adv.h')
+
+# Any #define line, enabled or commented out, as matched by configuration.apply_opt
+define_line = re.compile(r'^\s*(//\s*)?#define\s+(\w+)', re.IGNORECASE)
+
+class ConfigFile:
+    '''
+    The lines of one header with an index of the #define lines by name.
+    Edits are made to the lines in memory and written back by save().
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.load()
+
+    def load(self):
+        self.stamp = self.get_stamp()
+        self.text = self.path.read_text(encoding='utf-8')
+        self.lines = self.text.split('\n')
+        self.dirty = False
+        self.block_end = None
+        self.parse()
+
+    def get_stamp(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def parse(self):
+        # Single pass over the lines:
+        #  index   - NAME -> numbers of all the lines that define NAME, commented out or not
+        #  enabled - line number -> name of an enabled #define
+        self.index = {}
+        self.enabled = {}
+        for i, line in enumerate(self.lines):
+            if '#' in line: self.parse_line(i)
+
+    def parse_line(self, i):
+        line = self.lines[i]
+        match = define_line.match(line)
+        if match:
+            bisect.insort(self.index.setdefault(match[2].upper(), []), i)
+        sline = line.strip()
+        if sline[:7] == "#define":
+            kv = sline[8:].strip().split()
+            if kv: self.enabled[i] = kv[0]
+
+    def unparse_line(self, i):
+        match = define_line.match(self.lines[i])
+        if match:
+            self.index[match[2].upper()].remove(i)
+        self.enabled.pop(i, None)
+
+    # Names of the enabled #defines in file order
+    @property
+    def defines(self):
+        return [ self.enabled[i] for i in sorted(self.enabled) ]
+
+    # The lines as readlines() would give them, without the empty one after a final newline
+    @property
+    def file_lines(self):
+        return self.lines[:-1] if self.lines[-1] == '' else self.lines
+
+    # Numbers of the lines that may define 'name', in file order
+    def find(self, name):
+        if re.fullmatch(r'\w+', name):
+            # A copy, apply_opt edits the file while it walks the matches
+            return list(self.index.get(name.upper(), ()))
+        return range(len(self.lines))
+
+    # Number of the line after the first run of #define lines, where options are added
+    def define_block_end(self):
+        if self.block_end is None:
+            linenum = 0
+            gotdef = False
+            for line in self.file_lines:
+                isdef = line.startswith("#define")
+                if not gotdef:
+                    gotdef = isdef
+                elif not isdef:
+                    break
+                linenum += 1
+            self.block_end = linenum
+        return self.block_end
+
+    def set_line(self, i, line):
+        if self.lines[i] != line:
+            if self.block_end is not None and i <= self.block_end \
+               and self.lines[i].startswith("#define") != line.startswith("#define"):
+                self.block_end = None
+            self.unparse_line(i)
+            self.lines[i] = line
+            self.parse_line(i)
+            self.dirty = True
+
+    # Insert a line before line i. Inserting past the end of a file with no final
+    # newline runs on from the last line, like inserting into readlines() output.
+    def insert_line(self, i, line):
+        if i >= len(self.file_lines):
+            # Rare: the file ends in the first run of #defines. Just parse it again.
+            if i >= len(self.lines):
+                self.lines[-1] += line
+                self.lines.append('')
+            else:
+                self.lines.insert(i, line)
+            self.block_end = None
+            self.dirty = True
+            self.parse()
+            return
+
+        # Shift the indexed line numbers past the new line
+        for nums in self.index.values():
+            for n in range(bisect.bisect_left(nums, i), len(nums)):
+                nums[n] += 1
+        self.enabled = { (n + 1 if n >= i else n): name for n, name in self.enabled.items() }
+        self.lines.insert(i, line)
+        self.parse_line(i)
+        self.dirty = True
+
+        # A #define added at the end of the first run extends it
+        if self.block_end is not None:
+            if i == self.block_end:
+                self.block_end += line.startswith("#define")
+            else:
+                self.block_end = None
+
+    # Write the file through a temporary file so it is never left half written
+    def save(self):
+        if self.dirty:
+            self.text = '\n'.join(self.lines)
+            # Envs built in parallel save the same headers, each needs its own temp file
+            tmp = self.path.with_name('%s.%d.tmp' % (self.path.name, os.getpid()))
+            try:
+                tmp.write_text(self.text, encoding='utf-8')
+                shutil.copymode(self.path, tmp)
+                os.replace(tmp, self.path)
+            finally:
+                if tmp.exists(): tmp.unlink()
+            self.stamp = self.get_stamp()
+            self.dirty = False
+
+# Models by path, reloaded when the file changes on disk
+config_cache = {}
+
+def load(path):
+    key = str(Path(path).resolve())
+    cfile = config_cache.get(key)
+    if cfile is None:
+        cfile = config_cache[key] = ConfigFile(path)
+    elif not cfile.dirty and cfile.stamp != cfile.get_stamp():
+        cfile.load()
+    return cfile
+
+# Both Configuration headers as { filename : ConfigFile }
+def load_config(folder='Marlin'):
+    return { fn: load(Path(folder, fn)) for fn in CONFIG_FILES }
+
+# Write all files with pending edits
+def save_all():
+    for cfile in config_cache.values():
+        cfile.save()
+
+# Drop all models, e.g. after the files were replaced behind our back
+def forget():
+    config_cache.clear()
@@ -3,7 +3,9 @@
 # Apply options from config.ini to the existing Configuration headers
 #
 import re, shutil, configparser
+from functools import lru_cache
 from pathlib import Path
+import config_headers
 
 verbose = 0
 def blab(str,level=1):
@@ -12,41 +14,48 @@ def blab(str,level=1):
 def config_path(cpath):
     return Path("Marlin", cpath, encoding='utf-8')
 
+# A regex to match the option and capture parts of the line
+@lru_cache(maxsize=None)
+def option_regex(name):
+    return re.compile(rf'^(\s*)(//\s*)?(#define\s+)({name}\b)(\s*)(.*?)(\s*)(//.*)?$', re.IGNORECASE)
+
+enable_regex = re.compile(r'^(\s*)//+\s*(#define)(\s{1,3})?(\s*)')
+disable_regex = re.compile(r'^(\s*)(#define)(\s{1,3})?(\s*)')
+
 # Apply a single name = on/off ; name = value ; etc.
-# TODO: Limit to the given (optional) configuration
+# Edits are made to the shared config_headers model, call config_headers.save_all() to write them.
 def apply_opt(name, val, conf=None):
     if name == "lcd": name, val = val, "on"
 
-    # Create a regex to match the option and capture parts of the line
-    regex = re.compile(rf'^(\s*)(//\s*)?(#define\s+)({name}\b)(\s*)(.*?)(\s*)(//.*)?$', re.IGNORECASE)
+    conf = conf or config_headers.load_config()
+
+    regex = option_regex(name)
 
     # Find and enable and/or update all matches
     for file in ("Configuration.h", "Configuration_adv.h"):
-        fullpath = config_path(file)
-        lines = fullpath.read_text(encoding='utf-8').split('\n')
+        cfile = conf[file]
         found = False
-        for i in range(len(lines)):
-            line = lines[i]
+        for i in cfile.find(name):
+            line = cfile.lines[i]
             match = regex.match(line)
             if match and match[4].upper() == name.upper():
                 found = True
                 # For boolean options un/comment the define
                 if val in ("on", "", None):
-                    newline = re.sub(r'^(\s*)//+\s*(#define)(\s{1,3})?(\s*)', r'\1\2 \4', line)
+                    newline = enable_regex.sub(r'\1\2 \4', line)
                 elif val == "off":
-                    newline = re.sub(r'^(\s*)(#define)(\s{1,3})?(\s*)', r'\1//\2 \4', line)
+                    newline = disable_regex.sub(r'\1//\2 \4', line)
                 else:
                     # For options with values, enable and set the value
                     newline = match[1] + match[3] + match[4] + match[5] + val
                     if match[8]:
                         sp = match[7] if match[7] else ' '
                         newline += sp + match[8]
-                lines[i] = newline
+                cfile.set_line(i, newline)
                 blab(f"Set {name} to {val}")
 
-        # If the option was found, write the modified lines
+        # If the option was found, we're done
         if found:
-            fullpath.write_text('\n'.join(lines), encoding='utf-8')
             break
 
     # If the option didn't appear in either config file, add it
@@ -66,20 +75,15 @@ def apply_opt(name, val, conf=None):
             added += " " + val
 
         # Prepend the new option after the first set of #define lines
-        fullpath = config_path("Configuration.h")
-        with fullpath.open(encoding='utf-8') as f:
-            lines = f.readlines()
-            linenum = 0
-            gotdef = False
-            for line in lines:
-                isdef = line.startswith("#define")
-                if not gotdef:
-                    gotdef = isdef
-                elif not isdef:
-                    break
-                linenum += 1
-            lines.insert(linenum, f"{prefix}#define {added:30} // Added by config.ini\n")
-            fullpath.write_text(''.join(lines), encoding='utf-8')
+        cfile = conf["Configuration.h"]
+        cfile.insert_line(cfile.define_block_end(), f"{prefix}#define {added:30} // Added by config.ini")
+
+# Apply a list of (name, value) items in order, with the same result as
+# calling apply_opt for each one but loading the headers only once.
+def apply_opts(items, conf=None):
+    conf = conf or config_headers.load_config()
+    for name, val in items:
+        apply_opt(name, val, conf)
 
 # Fetch configuration files from GitHub given the path.
 # Return True if any files were fetched.
@@ -104,6 +108,8 @@ def fetch_example(url):
     import os
 
     # Reset configurations to default
+    config_headers.save_all()
+    config_headers.forget()
     os.system("git checkout HEAD Marlin/*.h")
 
     # Try to fetch the remote files
@@ -129,9 +135,7 @@ def apply_ini_by_name(cp, sect):
     else:
         items = section_items(cp, sect)
 
-    for item in items:
-        if iniok or not item[0].startswith('ini_'):
-            apply_opt(item[0], item[1])
+    apply_opts([ item for item in items if iniok or not item[0].startswith('ini_') ])
 
 # Apply all config sections from a parsed file
 def apply_all_sections(cp):
@@ -203,6 +207,9 @@ def apply_config_ini(cp):
             # Apply keyed sections after external files are done
             apply_sections(cp, 'config:' + ckey)
 
+    # Write each changed file once
+    config_headers.save_all()
+
 if __name__ == "__main__":
     #
     # From command line use the given file name
@@ -237,4 +244,5 @@ else:
             pass
 
         from platformio.project.config import ProjectConfig
-        apply_config_ini(ProjectConfig())
+        with pioutil.timing('configuration', env, 'configuration.py'):
+            apply_config_ini(ProjectConfig())
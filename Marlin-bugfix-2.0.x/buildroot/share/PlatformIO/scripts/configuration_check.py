@@ -0,0 +1,124 @@
+#
+# configuration_check.py
+# Check that configuration.apply_opts, which edits the shared config_headers model
+# and saves once, writes the same headers as applying each option on its own.
+#
+# The reference below is apply_opt as it was before the model: every option
+# reads the headers, edits the matching lines and writes them back. Random lists
+# of options, with repeated names, enabled and commented defines, values that
+# change the name of a line and new options, are applied both ways to copies of
+# the Marlin headers and the results compared byte for byte:
+#   python configuration_check.py --seeds 20 --items 150
+# Run it with the Python of PlatformIO, configuration.py imports SCons.
+#
+import argparse, random, re, shutil, sys, tempfile
+from pathlib import Path
+
+import config_headers, configuration
+
+def reference_apply_opt(folder, name, val):
+    if name == "lcd": name, val = val, "on"
+
+    regex = re.compile(rf'^(\s*)(//\s*)?(#define\s+)({name}\b)(\s*)(.*?)(\s*)(//.*)?$', re.IGNORECASE)
+
+    for file in ("Configuration.h", "Configuration_adv.h"):
+        fullpath = Path(folder, file)
+        lines = fullpath.read_text(encoding='utf-8').split('\n')
+        found = False
+        for i in range(len(lines)):
+            line = lines[i]
+            match = regex.match(line)
+            if match and match[4].upper() == name.upper():
+                found = True
+                if val in ("on", "", None):
+                    newline = re.sub(r'^(\s*)//+\s*(#define)(\s{1,3})?(\s*)', r'\1\2 \4', line)
+                elif val == "off":
+                    newline = re.sub(r'^(\s*)(#define)(\s{1,3})?(\s*)', r'\1//\2 \4', line)
+                else:
+                    newline = match[1] + match[3] + match[4] + match[5] + val
+                    if match[8]:
+                        sp = match[7] if match[7] else ' '
+                        newline += sp + match[8]
+                lines[i] = newline
+        if found:
+            fullpath.write_text('\n'.join(lines), encoding='utf-8')
+            break
+
+    if not found:
+        prefix = ""
+        if val == "off":
+            prefix, val = "//", ""
+        added = name.upper() if name.islower() else name
+        if val != "on" and val != "" and val is not None:
+            added += " " + val
+
+        fullpath = Path(folder, "Configuration.h")
+        with fullpath.open(encoding='utf-8') as f:
+            lines = f.readlines()
+            linenum = 0
+            gotdef = False
+            for line in lines:
+                isdef = line.startswith("#define")
+                if not gotdef:
+                    gotdef = isdef
+                elif not isdef:
+                    break
+                linenum += 1
+            lines.insert(linenum, f"{prefix}#define {added:30} // Added by config.ini\n")
+            fullpath.write_text(''.join(lines), encoding='utf-8')
+
+def random_items(rand, names, count):
+    # A small pool so names repeat, and values that rename a line (U8GLIB_SSD1306 123)
+    pool = rand.sample(names, 40) + [ 'U8GLIB_SSD1306', 'CONFIGURATION_H_VERSION', 'Mixed_Case' ] \
+         + [ 'new_option_%d' % i for i in range(6) ]
+    values = [ 'on', 'off', '', '42', '123', '"text"', '{ 1, 2 }', 'U8GLIB_SSD1306' ]
+    items = []
+    for _ in range(count):
+        name = rand.choice(pool)
+        if rand.random() < 0.5: name = name.lower()
+        items.append((name, rand.choice(values)))
+    return items
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare batched and sequential config.ini option application")
+    parser.add_argument('--seeds', type=int, default=10)
+    parser.add_argument('--items', type=int, default=150)
+    parser.add_argument('--marlin', default=str(Path(__file__).resolve().parents[4] / 'Marlin'), help='folder with the Configuration headers')
+    args = parser.parse_args()
+
+    source = Path(args.marlin)
+    text = ''.join(Path(source, fn).read_text(encoding='utf-8') for fn in config_headers.CONFIG_FILES)
+    define_line = re.compile(config_headers.define_line.pattern, re.IGNORECASE | re.MULTILINE)
+    names = sorted(set(match[2] for match in define_line.finditer(text)))
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as work:
+        for seed in range(args.seeds):
+            items = random_items(random.Random(seed), names, args.items)
+            batched, sequential = Path(work, 'batched'), Path(work, 'sequential')
+            for folder in (batched, sequential):
+                shutil.rmtree(folder, ignore_errors=True)
+                folder.mkdir()
+                for fn in config_headers.CONFIG_FILES:
+                    shutil.copy(Path(source, fn), folder)
+
+            config_headers.forget()
+            configuration.apply_opts(items, config_headers.load_config(batched))
+            config_headers.save_all()
+            for name, val in items:
+                reference_apply_opt(sequential, name, val)
+
+            for fn in config_headers.CONFIG_FILES:
+                got, want = Path(batched, fn).read_bytes(), Path(sequential, fn).read_bytes()
+                if got != want:
+                    failures += 1
+                    got_lines, want_lines = got.split(b'\n'), want.split(b'\n')
+                    line = next((i for i, (a, b) in enumerate(zip(got_lines, want_lines)) if a != b), min(len(got_lines), len(want_lines)))
+                    print("seed %d: %s differs at line %d" % (seed, fn, line + 1))
+
+    config_headers.forget()
+    print("%d seeds of %d options: %s" % (args.seeds, args.items, "FAIL" if failures else "OK"))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
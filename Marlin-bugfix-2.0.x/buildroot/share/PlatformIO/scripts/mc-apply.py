@@ -5,12 +5,23 @@
 import json
 import sys
 import shutil
+import zipfile
+import config_headers
 
 opt_output = '--opt' in sys.argv
 output_suffix = '.sh' if opt_output else '' if '--bare-output' in sys.argv else '.gen'
 
+# Open marlin_config.json, or read it straight from the mc.zip saved by 'M503 C'
+# (which may use LZMA compression that some unzip tools can't extract)
+def open_config():
+    try:
+        return open('marlin_config.json', 'r')
+    except FileNotFoundError:
+        zipf = zipfile.ZipFile('mc.zip')
+        return zipf.open([ n for n in zipf.namelist() if n.endswith('marlin_config.json') ][0])
+
 try:
-    with open('marlin_config.json', 'r') as infile:
+    with open_config() as infile:
         conf = json.load(infile)
         for key in conf:
             # We don't care about the hash when restoring here
@@ -41,20 +52,16 @@ try:
             # Try to apply changes to the actual configuration file (in order to keep useful comments)
             if output_suffix != '':
                 # Move the existing configuration so it doesn't interfere
+                cfile = config_headers.load('Marlin/' + key)
                 shutil.move('Marlin/' + key, 'Marlin/' + key + '.orig')
-                infile_lines = open('Marlin/' + key + '.orig', 'r').read().split('\n')
                 outfile = open('Marlin/' + key, 'w')
-                for line in infile_lines:
-                    sline = line.strip(" \t\n\r")
-                    if sline[:7] == "#define":
-                        # Extract the key here (we don't care about the value)
-                        kv = sline[8:].strip().split(' ')
-                        if kv[0] in conf[key]:
-                            outfile.write('#define ' + kv[0] + ' ' + conf[key][kv[0]] + '\n')
-                            # Remove the key from the dict, so we can still write all missing keys at the end of the file
-                            del conf[key][kv[0]]
-                        else:
-                            outfile.write(line + '\n')
+                for i, line in enumerate(cfile.lines):
+                    # The key of an enabled #define (we don't care about the value)
+                    name = cfile.enabled.get(i)
+                    if name in conf[key]:
+                        outfile.write('#define ' + name + ' ' + conf[key][name] + '\n')
+                        # Remove the key from the dict, so we can still write all missing keys at the end of the file
+                        del conf[key][name]
                     else:
                         outfile.write(line + '\n')
                 # Process any remaining defines here
@@ -65,4 +72,4 @@ try:
 
             print('Output configuration written to: ' + 'Marlin/' + key + output_suffix)
 except:
-    print('No marlin_config.json found.')
+    print('No marlin_config.json or mc.zip found.')
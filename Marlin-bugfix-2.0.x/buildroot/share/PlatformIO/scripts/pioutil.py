@@ -12,3 +12,75 @@ def is_pio_build():
 def get_pio_version():
     from platformio import util
     return util.pioversion_to_intstr()
+
+#
+# Build profiling
+#
+# Each timed phase appends a JSON line to the file named by $MARLIN_BUILD_TIMINGS,
+# as set by buildroot/share/scripts/build_envs.py.
+#
+# With 'custom_build_profile = on' in the env the phases are also written as a
+# Chrome trace to <build dir>/<env>/build_profile.json (or to the given file
+# name), to be opened in chrome://tracing or https://ui.perfetto.dev.
+# Each event has the script, the CPU time of the subprocesses run during the
+# phase and any details the script adds, such as preprocessor cache hits.
+#
+from contextlib import contextmanager
+
+trace_events = []
+trace_paths = {}
+
+def profile_path(env):
+    pioenv = env['PIOENV']
+    if pioenv not in trace_paths:
+        try:
+            val = env.GetProjectOption('custom_build_profile')
+        except:
+            val = None
+        path = None
+        if val and val.lower() not in ('0', 'off', 'false', 'no'):
+            from pathlib import Path
+            if val.lower() in ('1', 'on', 'true', 'yes'):
+                path = Path(env['PROJECT_BUILD_DIR'], pioenv, 'build_profile.json')
+            else:
+                path = Path(env['PROJECT_DIR'], val)
+        trace_paths[pioenv] = path
+    return trace_paths[pioenv]
+
+def write_trace(path):
+    import json, os
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(json.dumps({ 'traceEvents': trace_events, 'displayTimeUnit': 'ms' }))
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+# Time a phase of the build. Details can be added to the dict given by the 'with'.
+@contextmanager
+def timing(phase, env, script=None, **info):
+    import os, time, json
+    start, times = time.time(), os.times()
+    try:
+        yield info
+    finally:
+        seconds = time.time() - start
+        children = os.times()
+        child_cpu = children.children_user + children.children_system - times.children_user - times.children_system
+
+        path = os.environ.get('MARLIN_BUILD_TIMINGS')
+        if path:
+            record = dict(info, env=env['PIOENV'], phase=phase, start=start, seconds=seconds)
+            try:
+                with open(path, 'a') as outfile:
+                    outfile.write(json.dumps(record) + '\n')
+            except OSError:
+                pass
+
+        trace = profile_path(env)
+        if trace:
+            args = dict(info, subprocess_cpu_ms=round(max(child_cpu, 0) * 1000, 3))
+            trace_events.append({ 'name': phase, 'cat': script or phase, 'ph': 'X', 'pid': os.getpid(), 'tid': env['PIOENV'],
+                                  'ts': int(start * 1e6), 'dur': int(seconds * 1e6), 'args': args })
+            write_trace(trace)
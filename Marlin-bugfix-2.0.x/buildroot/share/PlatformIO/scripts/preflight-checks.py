@@ -9,45 +9,107 @@ if pioutil.is_pio_build():
     from pathlib import Path
     Import("env")
 
+    #
+    # Index of pins.h: board name -> the '#include' lines that follow
+    # each 'if MB(...)' naming the board. It is kept in the build folder
+    # and rebuilt when pins.h changes size, or changes time and content.
+    #
+    pins_index = {}
+    def load_pins_index(ppath):
+        if ppath in pins_index:
+            return pins_index[ppath]
+
+        import json, hashlib, os
+        ipath = Path(env['PROJECT_BUILD_DIR'], ".pins_index.json")
+        stat = ppath.stat()
+
+        def save(cached):
+            try:
+                ipath.parent.mkdir(parents=True, exist_ok=True)
+                # The index is shared by all envs, parallel builds each need their own temp file
+                tmp = ipath.with_name('%s.%d.tmp' % (ipath.name, os.getpid()))
+                tmp.write_text(json.dumps(cached))
+                tmp.replace(ipath)
+            except OSError:
+                pass
+
+        def expand(cached):
+            lines = cached['lines']
+            pins_index[ppath] = { board: [ lines[n] for n in nums ] for board, nums in cached['index'].items() }
+            return pins_index[ppath]
+
+        try:
+            with ipath.open() as infile:
+                cached = json.load(infile)
+            if cached['size'] == stat.st_size:
+                if cached['mtime'] == stat.st_mtime_ns:
+                    return expand(cached)
+                if cached['sha256'] == hashlib.sha256(ppath.read_bytes()).hexdigest():
+                    cached['mtime'] = stat.st_mtime_ns  # Touched but unchanged
+                    save(cached)
+                    return expand(cached)
+        except:
+            pass
+
+        index = {}      # board -> numbers of the '#include' lines
+        skip = {}       # board -> number of the '#include' line read after its last MB()
+        r = re.compile(r"if\s+MB\((.+)\)")
+        with ppath.open() as file:
+            lines = file.readlines() + [ '' ]
+        for i, line in enumerate(lines):
+            mbs = r.findall(line)
+            if mbs:
+                for board in re.split(r",\s*", mbs[0]):
+                    if skip.get(board) != i:
+                        index.setdefault(board, []).append(i + 1)
+                        skip[board] = i + 1
+
+        # Keep only the '#include' lines, renumbered
+        used = sorted({ n for nums in index.values() for n in nums })
+        renum = { n: k for k, n in enumerate(used) }
+        cached = { 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': hashlib.sha256(ppath.read_bytes()).hexdigest(),
+                   'lines': [ lines[n] for n in used ], 'index': { board: [ renum[n] for n in nums ] for board, nums in index.items() } }
+        save(cached)
+        return expand(cached)
+
     def get_envs_for_board(board):
         ppath = Path("Marlin/src/pins/pins.h")
-        with ppath.open() as file:
 
-            if sys.platform == 'win32':
-                envregex = r"(?:env|win):"
-            elif sys.platform == 'darwin':
-                envregex = r"(?:env|mac|uni):"
-            elif sys.platform == 'linux':
-                envregex = r"(?:env|lin|uni):"
-            else:
-                envregex = r"(?:env):"
-
-            r = re.compile(r"if\s+MB\((.+)\)")
-            if board.startswith("BOARD_"):
-                board = board[6:]
-
-            for line in file:
-                mbs = r.findall(line)
-                if mbs and board in re.split(r",\s*", mbs[0]):
-                    line = file.readline()
-                    found_envs = re.match(r"\s*#include .+" + envregex, line)
-                    if found_envs:
-                        envlist = re.findall(envregex + r"(\w+)", line)
-                        return [ "env:"+s for s in envlist ]
+        if sys.platform == 'win32':
+            envregex = r"(?:env|win):"
+        elif sys.platform == 'darwin':
+            envregex = r"(?:env|mac|uni):"
+        elif sys.platform == 'linux':
+            envregex = r"(?:env|lin|uni):"
+        else:
+            envregex = r"(?:env):"
+
+        if board.startswith("BOARD_"):
+            board = board[6:]
+
+        for line in load_pins_index(ppath).get(board, []):
+            found_envs = re.match(r"\s*#include .+" + envregex, line)
+            if found_envs:
+                envlist = re.findall(envregex + r"(\w+)", line)
+                return [ "env:"+s for s in envlist ]
         return []
 
-    def check_envs(build_env, board_envs, config):
-        if build_env in board_envs:
-            return True
-        ext = config.get(build_env, 'extends', default=None)
-        if ext:
+    # The env and all the envs it extends, directly or not
+    env_lineage = {}
+    def get_lineage(build_env, config):
+        if build_env not in env_lineage:
+            env_lineage[build_env] = { build_env }    # Stops an 'extends' loop
+            lineage = { build_env }
+            ext = config.get(build_env, 'extends', default=None)
             if isinstance(ext, str):
-                return check_envs(ext, board_envs, config)
-            elif isinstance(ext, list):
-                for ext_env in ext:
-                    if check_envs(ext_env, board_envs, config):
-                        return True
-        return False
+                ext = [ ext ]
+            for ext_env in ext or []:
+                lineage |= get_lineage(ext_env, config)
+            env_lineage[build_env] = lineage
+        return env_lineage[build_env]
+
+    def check_envs(build_env, board_envs, config):
+        return not get_lineage(build_env, config).isdisjoint(board_envs)
 
     def sanity_check_target():
         # Sanity checks:
@@ -133,4 +195,5 @@ if pioutil.is_pio_build():
                     err = "ERROR: FILAMENT_RUNOUT_SCRIPT needs a %c parameter (e.g., 'M600 T%c') when NUM_RUNOUT_SENSORS is > 1."
                     raise SystemExit(err)
 
-    sanity_check_target()
+    with pioutil.timing('preflight', env, 'preflight-checks.py'):
+        sanity_check_target()
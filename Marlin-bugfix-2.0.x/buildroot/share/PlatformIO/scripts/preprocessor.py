@@ -1,7 +1,9 @@
 #
 # preprocessor.py
 #
-import subprocess
+import subprocess,os,re,json,hashlib,shutil,time
+from contextlib import contextmanager
+import pioutil
 
 nocache = 1
 verbose = 0
@@ -38,15 +40,168 @@ def run_preprocessor(env, fn=None):
 
     cmd += ['-D__MARLIN_DEPS__ -w -dM -E -x c++']
     depcmd = cmd + [ filename ]
-    cmd = ' '.join(depcmd)
+
+    # Reuse the output of an earlier build if the compiler, the flags and
+    # every header the preprocessor read are still the same
+    with pioutil.timing('preprocess', env, 'preprocessor.py', file=filename) as info:
+        cache = PersistentCache(env)
+        key = cache.key(cxx, depcmd)
+        define_list = cache.lookup(key)
+        if define_list is None:
+            # Envs built at the same time with the same flags share one run
+            with cache.locked(key):
+                define_list = cache.lookup(key)
+                if define_list is None:
+                    define_list = preprocess(env, cache, key, cmd, filename)
+                    info['cache'] = 'miss'
+        if define_list is not None and 'cache' not in info:
+            blab("Using cached preprocessor output for %s" % filename)
+            info['cache'] = 'hit'
+
+    preprocessor_cache[filename] = define_list
+    return define_list
+
+def preprocess(env, cache, key, cmd, filename):
+    depfile = cache.depfile(key)
+    if depfile:
+        cmd = cmd + ['-MD -MF "%s"' % depfile]
+    cmd = ' '.join(cmd + [ filename ])
     blab(cmd)
     try:
-        define_list = subprocess.check_output(cmd, shell=True).splitlines()
+        with pioutil.timing('compiler', env, 'preprocessor.py'):
+            define_list = subprocess.check_output(cmd, shell=True).splitlines()
+        if depfile:
+            cache.store(key, define_list, depfile)
     except:
         define_list = {}
-    preprocessor_cache[filename] = define_list
     return define_list
 
+#
+# Preprocessor output kept across builds, with the headers listed by '-MD'.
+# A header counts as changed when its size differs, or its timestamp differs
+# and so does its content.
+#
+# Entries are files named by the hash of the compiler and the command line,
+# in a folder shared by all the envs of the project, so envs that run the
+# same preprocessor command use the same entry.
+#
+class PersistentCache:
+
+    # Give up waiting for another build after this many seconds
+    lock_timeout = 300
+
+    def __init__(self, env):
+        self.path = None
+        try:
+            self.path = os.path.join(env['PROJECT_BUILD_DIR'], ".preprocessor")
+            os.makedirs(self.path, exist_ok=True)
+        except:
+            self.path = None
+
+    def entry_path(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def depfile(self, key):
+        return self.path and key and self.entry_path(key, ".d")
+
+    # Hold the lock on an entry while it is computed. Another holder is
+    # waited for, unless it looks like it died with the lock held.
+    @contextmanager
+    def locked(self, key):
+        lockfile = self.path and key and self.entry_path(key, ".lock")
+        fd = None
+        start = time.time()
+        while lockfile:
+            try:
+                fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(lockfile).st_mtime > self.lock_timeout:
+                        os.remove(lockfile)
+                        continue
+                except OSError:
+                    continue
+                if time.time() - start > self.lock_timeout:
+                    break
+                time.sleep(0.1)
+            except OSError:
+                break
+        try:
+            yield
+        finally:
+            if fd is not None:
+                os.close(fd)
+                os.remove(lockfile)
+
+    def key(self, cxx, cmd):
+        # Stands in for the compiler version: an updated toolchain has a new g++ binary
+        try:
+            stat = os.stat(shutil.which(cxx) or cxx)
+            compiler = [stat.st_size, stat.st_mtime_ns]
+        except:
+            return None
+        return hashlib.sha256(json.dumps([compiler, cmd]).encode()).hexdigest()
+
+    def load(self, key):
+        try:
+            with open(self.entry_path(key, ".json")) as infile:
+                return json.load(infile)
+        except:
+            return None
+
+    def lookup(self, key):
+        entry = self.path and key and self.load(key)
+        if not entry:
+            return None
+        touched = False
+        for path, dep in entry['deps'].items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            if stat.st_size != dep[0]:
+                return None
+            if stat.st_mtime_ns != dep[1]:
+                if file_digest(path) != dep[2]:
+                    return None
+                dep[1] = stat.st_mtime_ns   # touched but unchanged, skip hashing it next time
+                touched = True
+        if touched:
+            self.save(key, entry)
+        return [line.encode('latin-1') for line in entry['defines']]
+
+    def store(self, key, define_list, depfile):
+        try:
+            with open(depfile) as infile:
+                headers = parse_depfile(infile.read())
+            deps = {}
+            for path in headers:
+                stat = os.stat(path)
+                deps[path] = [stat.st_size, stat.st_mtime_ns, file_digest(path)]
+        except OSError:
+            return
+        self.save(key, { 'defines': [line.decode('latin-1') for line in define_list], 'deps': deps })
+
+    def save(self, key, entry):
+        path = self.entry_path(key, ".json")
+        try:
+            with open("%s.%d" % (path, os.getpid()), 'w') as outfile:
+                json.dump(entry, outfile)
+            os.replace(outfile.name, path)
+        except OSError:
+            pass
+
+def file_digest(path):
+    with open(path, 'rb') as infile:
+        return hashlib.sha256(infile.read()).hexdigest()
+
+# Prerequisites of the make rule written by '-MD', spaces in names are escaped as '\ '
+def parse_depfile(text):
+    text = text.replace('\\\n', ' ')
+    deps = re.split(r':\s', text, 1)[-1]
+    return [ dep.replace('\\ ', ' ') for dep in re.split(r'(?<!\\)\s+', deps.strip()) if dep ]
+
 
 ################################################################################
 #
@@ -2,8 +2,10 @@
 # signature.py
 #
 import schema
+import config_headers
+import pioutil
 
-import subprocess,re,json,hashlib
+import subprocess,re,json,hashlib,io
 from datetime import datetime
 from pathlib import Path
 
@@ -16,15 +18,7 @@ from pathlib import Path
 # resulting config.ini to produce more exact configuration files.
 #
 def extract_defines(filepath):
-    f = open(filepath, encoding="utf8").read().split("\n")
-    a = []
-    for line in f:
-        sline = line.strip()
-        if sline[:7] == "#define":
-            # Extract the key here (we don't care about the value)
-            kv = sline[8:].strip().split()
-            a.append(kv[0])
-    return a
+    return config_headers.load(filepath).defines
 
 # Compute the SHA256 hash of a file
 def get_file_sha256sum(filepath):
@@ -35,13 +29,39 @@ def get_file_sha256sum(filepath):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
+# Write a file only if its content changes, so it doesn't trigger a rebuild
+def write_if_changed(filepath, content:bytes):
+    filepath = Path(filepath)
+    try:
+        if filepath.read_bytes() == content:
+            return False
+    except OSError:
+        pass
+    filepath.write_bytes(content)
+    return True
+
 #
-# Compress a JSON file into a zip file
+# Compress a JSON file into a zip file with the method (deflate, bzip2 or
+# LZMA) that gives the smallest archive. The zip entry records the method
+# for the unzip tool. The entry name, date and attributes are fixed, so the
+# same JSON always gives the same zip.
 #
 import zipfile
 def compress_file(filepath, outpath):
-    with zipfile.ZipFile(outpath, 'w', compression=zipfile.ZIP_BZIP2, compresslevel=9) as zipf:
-        zipf.write(filepath, compress_type=zipfile.ZIP_BZIP2, compresslevel=9)
+    filepath = Path(filepath)
+    data = filepath.read_bytes()
+    best = None
+    for method in (zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+        info = zipfile.ZipInfo(filepath.name, date_time=(1980, 1, 1, 0, 0, 0))
+        info.compress_type = method
+        info.create_system = 3              # Unix, for the file mode below
+        info.external_attr = 0o644 << 16
+        zbuf = io.BytesIO()
+        with zipfile.ZipFile(zbuf, 'w') as zipf:
+            zipf.writestr(info, data, compresslevel=9)
+        if best is None or len(zbuf.getvalue()) < len(best):
+            best = zbuf.getvalue()
+    write_if_changed(outpath, best)
 
 #
 # Compute the build signature. The idea is to extract all defines in the configuration headers
@@ -58,9 +78,8 @@ def compute_build_signature(env):
     build_path = Path(env['PROJECT_BUILD_DIR'], env['PIOENV'])
 
     # Check if we can skip processing
-    hashes = ''
-    for header in files_to_keep:
-        hashes += get_file_sha256sum(header)[0:10]
+    header_hashes = { header: get_file_sha256sum(header) for header in files_to_keep }
+    hashes = ''.join(header_hashes[header][0:10] for header in files_to_keep)
 
     marlin_json = build_path / 'marlin_config.json'
     marlin_zip = build_path / 'mc.zip'
@@ -76,20 +95,45 @@ def compute_build_signature(env):
     except:
         pass
 
+    # Defines found in each header by the last run, to re-read only the changed header
+    signature_state = build_path / 'signature_state.json'
+    try:
+        with signature_state.open() as infile:
+            state = json.load(infile)
+    except:
+        state = {}
+
     # Get enabled config options based on preprocessor
     from preprocessor import run_preprocessor
     complete_cfg = run_preprocessor(env)
 
     # Dumb #define extraction from the configuration files
     conf_defines = {}
-    all_defines = []
     for header in files_to_keep:
-        defines = extract_defines(header)
-        # To filter only the define we want
-        all_defines += defines
+        cached = state.get(header)
+        if cached and cached['hash'] == header_hashes[header]:
+            defines = cached['defines']
+        else:
+            defines = extract_defines(header)
+            state[header] = { 'hash': header_hashes[header], 'defines': defines }
         # To remember from which file it cames from
         conf_defines[header.split('/')[-1]] = defines
 
+    try:
+        with signature_state.open('w') as outfile:
+            json.dump(state, outfile)
+    except:
+        pass
+
+    # Headers defining each macro, also used to filter only the define we want
+    define_headers = {}
+    for header, header_defines in conf_defines.items():
+        for key in header_defines:
+            owners = define_headers.setdefault(key, [])
+            if header not in owners:
+                owners.append(header)
+    keep_anyway = { 'DETAILED_BUILD_VERSION', 'STRING_DISTRIBUTION_DATE' }
+
     r = re.compile(r"\(+(\s*-*\s*_.*)\)+")
 
     # First step is to collect all valid macros
@@ -132,7 +176,7 @@ def compute_build_signature(env):
         if key.endswith("_T_DECLARED"):
             continue
         # Remove keys that are not in the #define list in the Configuration list
-        if key not in all_defines + [ 'DETAILED_BUILD_VERSION', 'STRING_DISTRIBUTION_DATE' ]:
+        if key not in define_headers and key not in keep_anyway:
             continue
 
         # Don't be that smart guy here
@@ -146,11 +190,10 @@ def compute_build_signature(env):
     for header in conf_defines:
         data[header] = {}
 
-    # Then populate the object where each key is going to (that's a O(N^2) algorithm here...)
+    # Then populate the object where each key is going to
     for key in resolved_defines:
-        for header in conf_defines:
-            if key in conf_defines[header]:
-                data[header][key] = resolved_defines[key]
+        for header in define_headers.get(key, ()):
+            data[header][key] = resolved_defines[key]
 
     # Every python needs this toy
     def tryint(key):
@@ -200,7 +243,8 @@ def compute_build_signature(env):
     #
     if config_dump >= 3:
         try:
-            conf_schema = schema.extract()
+            with pioutil.timing('schema', env, 'schema.py') as stats:
+                conf_schema = schema.extract_cached(build_path / 'schema_cache.json', stats)
         except Exception as exc:
             print("Error: " + str(exc))
             conf_schema = None
@@ -245,8 +289,7 @@ def compute_build_signature(env):
     # Produce a JSON file for CONFIGURATION_EMBEDDING or CONFIG_EXPORT == 1
     #
     if config_dump == 1 or 'CONFIGURATION_EMBEDDING' in defines:
-        with marlin_json.open('w') as outfile:
-            json.dump(data, outfile, separators=(',', ':'))
+        write_if_changed(marlin_json, json.dumps(data, separators=(',', ':'), sort_keys=True).encode())
 
     #
     # The rest only applies to CONFIGURATION_EMBEDDING
@@ -257,20 +300,14 @@ def compute_build_signature(env):
     # Compress the JSON file as much as we can
     compress_file(marlin_json, marlin_zip)
 
-    # Generate a C source file for storing this array
-    with open('Marlin/src/mczip.h','wb') as result_file:
-        result_file.write(
-              b'#ifndef NO_CONFIGURATION_EMBEDDING_WARNING\n'
-            + b'  #warning "Generated file \'mc.zip\' is embedded (Define NO_CONFIGURATION_EMBEDDING_WARNING to suppress this warning.)"\n'
-            + b'#endif\n'
-            + b'const unsigned char mc_zip[] PROGMEM = {\n '
-        )
-        count = 0
-        for b in (build_path / 'mc.zip').open('rb').read():
-            result_file.write(b' 0x%02X,' % b)
-            count += 1
-            if count % 16 == 0:
-                result_file.write(b'\n ')
-        if count % 16:
-            result_file.write(b'\n')
-        result_file.write(b'};\n')
+    # Generate a C source file for storing this array, 16 bytes per line
+    zdata = marlin_zip.read_bytes()
+    rows = [ zdata[i:i+16] for i in range(0, len(zdata), 16) ]
+    write_if_changed('Marlin/src/mczip.h', (
+          '#ifndef NO_CONFIGURATION_EMBEDDING_WARNING\n'
+        + '  #warning "Generated file \'mc.zip\' is embedded (Define NO_CONFIGURATION_EMBEDDING_WARNING to suppress this warning.)"\n'
+        + '#endif\n'
+        + 'const unsigned char mc_zip[] PROGMEM = {\n '
+        + ''.join(''.join(' 0x%02X,' % b for b in row) + ('\n ' if len(row) == 16 else '\n') for row in rows)
+        + '};\n'
+    ).encode())
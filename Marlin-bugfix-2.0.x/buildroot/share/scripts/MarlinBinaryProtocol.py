@@ -3,23 +3,43 @@
 # Supporting Firmware upload via USB/Serial, saving to the attached media.
 #
 import serial
-import math
 import time
 from collections import deque
 import threading
 import sys
+import os
 import datetime
 import random
+import struct
+import mmap
+import queue
+import json
+import hashlib
 try:
     import heatshrink
-    heatshrink_exists = True
+    heatshrink_bundled = False
 except ImportError:
-    heatshrink_exists = False
+    # Fall back to the bundled pure Python encoder, the host only needs to encode
+    import heatshrink_encoder as heatshrink
+    heatshrink_bundled = True
+heatshrink_exists = True
+
+import gcode_compact
 
 
 def millis():
     return time.perf_counter() * 1000
 
+# Marlin's default RX buffer, used when RX_BUFFER_SIZE is not configured
+DEFAULT_RX_BUFFER_SIZE = 128
+
+def rx_buffer_size(marlin_features):
+    # Same source as stm32_serialbuffer.py: RX_BUFFER_SIZE from the MARLIN_FEATURES of the build
+    try:
+        return int(marlin_features['RX_BUFFER_SIZE'])
+    except (KeyError, TypeError, ValueError):
+        return DEFAULT_RX_BUFFER_SIZE
+
 class TimeOut(object):
     def __init__(self, milliseconds):
         self.duration = milliseconds
@@ -41,6 +61,138 @@ class PayloadOverflow(Exception):
     pass
 class ConnectionLost(Exception):
     pass
+class OpenError(Exception):
+    pass
+
+class ProtocolMetrics(object):
+    """Link health counters of one Protocol: traffic, retransmissions and their
+    cause, the per-packet round trip time and the time spent in each transfer
+    phase. snapshot() returns them as a dict, export() appends a JSON line or
+    writes Prometheus text (for the node_exporter textfile collector)."""
+    rtt_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)   # ms, upper bounds
+    export_lock = threading.Lock()
+
+    def __init__(self):
+        self.packets_sent = 0       # distinct packets, retransmissions not included
+        self.bytes_sent = 0         # everything written to the port, retransmissions included
+        self.payload_bytes = 0
+        self.retransmits = 0
+        self.resends = 0            # retransmissions requested by the client ('rs')
+        self.timeouts = 0           # retransmissions after a response timeout
+        self.reconnects = 0
+        self.source_bytes = 0       # file bytes streamed by FileTransferProtocol
+        self.stream_bytes = 0       # the same after compression
+        self.rtt_counts = [0] * (len(self.rtt_buckets) + 1)
+        self.rtt_sum = 0.0
+        self.phases = {}            # name -> [count, total ms]
+        self.start_time = time.time()
+
+    def transmitted(self, length, retransmit):
+        self.bytes_sent += length
+        if retransmit:
+            self.retransmits += 1
+
+    def acknowledged(self, payload_length, rtt):
+        self.packets_sent += 1
+        self.payload_bytes += payload_length
+        self.rtt_sum += rtt
+        for i, bound in enumerate(self.rtt_buckets):
+            if rtt <= bound:
+                self.rtt_counts[i] += 1
+                return
+        self.rtt_counts[-1] += 1
+
+    def streamed(self, source_bytes, stream_bytes):
+        self.source_bytes += source_bytes
+        self.stream_bytes += stream_bytes
+
+    class Phase(object):
+        def __init__(self, metrics, name):
+            self.metrics = metrics
+            self.name = name
+
+        def __enter__(self):
+            self.start_time = millis()
+
+        def __exit__(self, *exc):
+            self.metrics.add_phase(self.name, millis() - self.start_time)
+
+    def phase(self, name):
+        # with metrics.phase('open'): ...
+        return self.Phase(self, name)
+
+    def add_phase(self, name, elapsed):
+        entry = self.phases.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+
+    def snapshot(self, **labels):
+        attempts = self.packets_sent + self.retransmits
+        return {
+            'time': time.time(),
+            'labels': labels,
+            'uptime': time.time() - self.start_time,
+            'packets_sent': self.packets_sent,
+            'bytes_sent': self.bytes_sent,
+            'payload_bytes': self.payload_bytes,
+            'retransmits': self.retransmits,
+            'resends': self.resends,
+            'timeouts': self.timeouts,
+            'reconnects': self.reconnects,
+            'error_rate': self.retransmits / attempts if attempts else 0.0,
+            'compression_ratio': self.source_bytes / self.stream_bytes if self.stream_bytes else 1.0,
+            'rtt_ms': {'buckets': dict(zip([str(b) for b in self.rtt_buckets] + ['+Inf'], self.rtt_counts)), 'sum': self.rtt_sum, 'count': self.packets_sent},
+            'phases_ms': {name: {'count': count, 'total': total} for name, (count, total) in self.phases.items()},
+        }
+
+    def to_json(self, **labels):
+        return json.dumps(self.snapshot(**labels), sort_keys=True)
+
+    def to_prometheus(self, prefix = 'marlin_binary_protocol', **labels):
+        def series(name, value, extra = {}):
+            tags = ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(dict(labels, **extra).items()))
+            return '{0}_{1}{2} {3}'.format(prefix, name, '{' + tags + '}' if tags else '', value)
+
+        lines = []
+        def metric(name, kind, text, values):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, text))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+            lines.extend(values)
+
+        metric('packets_sent_total', 'counter', 'Acknowledged packets', [series('packets_sent_total', self.packets_sent)])
+        metric('bytes_sent_total', 'counter', 'Bytes written to the port', [series('bytes_sent_total', self.bytes_sent)])
+        metric('payload_bytes_total', 'counter', 'Acknowledged payload bytes', [series('payload_bytes_total', self.payload_bytes)])
+        metric('retransmits_total', 'counter', 'Packets sent again', [series('retransmits_total', self.retransmits)])
+        metric('resends_total', 'counter', 'Resend requests (rs) from the client', [series('resends_total', self.resends)])
+        metric('timeouts_total', 'counter', 'Response timeouts', [series('timeouts_total', self.timeouts)])
+        metric('reconnects_total', 'counter', 'Port reopened after a connection loss', [series('reconnects_total', self.reconnects)])
+        metric('compression_ratio', 'gauge', 'Source bytes per streamed byte', [
+            series('compression_ratio', self.source_bytes / self.stream_bytes if self.stream_bytes else 1.0)])
+
+        buckets, count = [], 0
+        for bound, n in zip([str(b) for b in self.rtt_buckets] + ['+Inf'], self.rtt_counts):
+            count += n
+            buckets.append(series('rtt_ms_bucket', count, {'le': bound}))
+        buckets.append(series('rtt_ms_sum', self.rtt_sum))
+        buckets.append(series('rtt_ms_count', self.packets_sent))
+        metric('rtt_ms', 'histogram', 'Round trip time from the last transmission to the ok', buckets)
+
+        metric('phase_ms_total', 'counter', 'Time spent per transfer phase', [
+            series('phase_ms_total', total, {'phase': name}) for name, (count, total) in sorted(self.phases.items())])
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, **labels):
+        # '.prom' files hold the current state, anything else collects one JSON line per call
+        with self.export_lock:
+            if path.endswith('.prom'):
+                temp_path = path + ".tmp"
+                with open(temp_path, "w") as outfile:
+                    outfile.write(self.to_prometheus(**labels))
+                os.replace(temp_path, path)
+            else:
+                with open(path, "a") as outfile:
+                    outfile.write(self.to_json(**labels) + '\n')
+
 
 class Protocol(object):
     device = None
@@ -55,6 +207,7 @@ class Protocol(object):
 
     errors = 0
     packet_buffer = None
+    packet_buffers = None
     simulate_errors = 0
     sync = 0
     connected = False
@@ -62,50 +215,62 @@ class Protocol(object):
     worker_thread = None
 
     response_timeout = 1000
+    resend_history = 64
 
-    applications = []
-    responses = deque()
+    reconnect_attempts = 8
+    reconnect_delay = 50        # ms, doubled after every failed attempt
+    reconnect_delay_max = 2000
+    reconnects = 0
+    online = None               # set while the port is open
+    reconnected = None          # set by the receive worker after reopening the port
+    packet_args = None          # (protocol, packet_type, data) of the packet in transit
+
+    applications = None     # token prefix trie, see register()
+    responses = None
+    metrics = None
+    transmit_time = 0
 
     def __init__(self, device, baud, bsize, simerr, timeout):
         print("pySerial Version:", serial.VERSION)
-        self.port = serial.Serial(device, baudrate = baud, write_timeout = 0, timeout = 1)
         self.device = device
         self.baud = baud
+        self.port = self.open_port()
         self.block_size = int(bsize)
         self.simulate_errors = max(min(simerr, 1.0), 0.0);
         self.connected = True
         self.response_timeout = timeout
+        self.packet_buffers = {}
+        self.applications = {}
+        self.responses = deque()
+        self.online = threading.Event()
+        self.online.set()
+        self.reconnected = threading.Event()
+        self.metrics = ProtocolMetrics()
 
-        self.register(['ok', 'rs', 'ss', 'fe'], self.process_input)
+        self.register(['ok', 'rs', 'ss', 'fe', 'Resend:'], self.process_input)
 
         self.worker_thread = threading.Thread(target=Protocol.receive_worker, args=(self,))
         self.worker_thread.start()
 
+    def open_port(self):
+        # Overridden to run the protocol over something else than a serial port, see binary_protocol_soak.py
+        return serial.Serial(self.device, baudrate = self.baud, write_timeout = 0, timeout = 1)
+
     def receive_worker(self):
         while self.port.in_waiting:
             self.port.reset_input_buffer()
 
         def dispatch(data):
-            for tokens, callback in self.applications:
-                for token in tokens:
-                    if token == data[:len(token)]:
-                        callback((token, data[len(token):]))
-                        return
-
-        def reconnect():
-            print("Reconnecting..")
-            self.port.close()
-            for x in range(10):
-                try:
-                    if self.connected:
-                        self.port = serial.Serial(self.device, baudrate = self.baud, write_timeout = 0, timeout = 1)
-                        return
-                    else:
-                        print("Connection closed")
-                        return
-                except:
-                    time.sleep(1)
-            raise ConnectionLost()
+            # Walk the token trie, the first (shortest) registered token that prefixes the line wins
+            node = self.applications
+            for i, c in enumerate(data):
+                node = node.get(c)
+                if node is None:
+                    return
+                if None in node:
+                    token, callback = node[None]
+                    callback((token, data[i + 1:]))
+                    return
 
         while self.connected:
             try:
@@ -114,11 +279,72 @@ class Protocol(object):
                     #print(data)
                     dispatch(data)
             except OSError:
-                reconnect()
+                if not self.reopen_port():
+                    return
             except UnicodeDecodeError:
                 # dodgy client output or datastream corruption
                 self.port.reset_input_buffer()
 
+    def reopen_port(self):
+        # Reopen the port with exponential backoff, the sender restores the session
+        print("Reconnecting..")
+        self.online.clear()
+        try:
+            self.port.close()
+        except OSError:
+            pass
+        delay = self.reconnect_delay
+        for x in range(self.reconnect_attempts):
+            if not self.connected:
+                print("Connection closed")
+                return False
+            try:
+                self.port = self.open_port()
+                self.reconnects += 1
+                self.metrics.reconnects += 1
+                self.reconnected.set()
+                self.online.set()
+                return True
+            except OSError:
+                time.sleep(delay / 1000)
+                delay = min(delay * 2, self.reconnect_delay_max)
+        print("Connection lost")
+        self.connected = False
+        self.online.set()   # wake up a waiting sender, it will find the connection gone
+        return False
+
+    def wait_online(self):
+        timeout = self.reconnect_delay_max * self.reconnect_attempts / 1000
+        return self.online.wait(timeout) and self.connected
+
+    def restore_session(self):
+        # Back in binary mode after a reconnect: resync the stream, then either
+        # confirm the packet in transit (its 'ok' got lost) or send it again
+        self.reconnected.clear()
+        last_sync = self.sync
+        self.responses.clear()
+        self.port.write(b"M28B1\n")    # ignored unless the client fell back to ASCII mode
+        self.syncronised = False
+        timeout = TimeOut(self.response_timeout * 5)
+        while not self.syncronised:
+            if timeout.timedout():
+                raise ConnectionLost()
+            self.transmit_packet(self.build_packet(0, 1))
+            try:
+                self.await_response()
+            except (ReadTimeout, SycronisationError):
+                pass    # late or stale responses from before the reconnect
+        if self.packet_args is None:
+            return
+        if self.sync == (last_sync + 1) % 256:
+            self.packet_status = 1
+        elif self.sync == last_sync:
+            self.packet_status = 0
+            self.packet_transit = self.build_packet(*self.packet_args)
+        else:
+            # The client was reset, its transfer state is gone
+            raise ConnectionLost()
+
     def shutdown(self):
         self.connected = False
         self.worker_thread.join()
@@ -129,9 +355,15 @@ class Protocol(object):
         self.responses.append(data)
 
     def register(self, tokens, callback):
-        self.applications.append((tokens, callback))
+        # Index the tokens by character so dispatch cost only depends on the token length
+        for token in tokens:
+            node = self.applications
+            for c in token:
+                node = node.setdefault(c, {})
+            node.setdefault(None, (token, callback))
 
     def send(self, protocol, packet_type, data = bytearray()):
+        self.packet_args = (protocol, packet_type, data)
         self.packet_transit = self.build_packet(protocol, packet_type, data)
         self.packet_status = 0
         self.transmit_attempt = 0
@@ -139,14 +371,29 @@ class Protocol(object):
         timeout = TimeOut(self.response_timeout * 20)
         while self.packet_status == 0:
             try:
+                if self.reconnected.is_set():
+                    self.restore_session()
+                    timeout.reset()
+                    continue
                 if timeout.timedout():
                     raise ConnectionLost()
                 self.transmit_packet(self.packet_transit)
                 self.await_response()
             except ReadTimeout:
                 self.errors += 1
+                self.metrics.timeouts += 1
                 #print("Packetloss detected..")
+            except SycronisationError:
+                # A mangled response, the client answers the retransmission either way
+                self.errors += 1
+            except OSError:
+                # The port went away, wait for the receive worker to reopen it
+                if not self.wait_online():
+                    raise ConnectionLost()
+                timeout.reset()
+        self.metrics.acknowledged(len(data), millis() - self.transmit_time)
         self.packet_transit = None
+        self.packet_args = None
 
     def await_response(self):
         timeout = TimeOut(self.response_timeout)
@@ -157,7 +404,7 @@ class Protocol(object):
 
         while len(self.responses):
             token, data = self.responses.popleft()
-            switch = {'ok' : self.response_ok, 'rs': self.response_resend, 'ss' : self.response_stream_sync, 'fe' : self.response_fatal_error}
+            switch = {'ok' : self.response_ok, 'rs': self.response_resend, 'ss' : self.response_stream_sync, 'fe' : self.response_fatal_error, 'Resend:' : self.response_resend_ascii}
             switch[token](data)
 
     def send_ascii(self, data, send_and_forget = False):
@@ -184,12 +431,125 @@ class Protocol(object):
 
     def await_response_ascii(self):
         timeout = TimeOut(self.response_timeout)
-        while not len(self.responses):
-            time.sleep(0.00001)
-            if timeout.timedout():
-                raise ReadTimeout()
-        token, data = self.responses.popleft()
-        self.packet_status = 1
+        while self.packet_status == 0:
+            while not len(self.responses):
+                time.sleep(0.00001)
+                if timeout.timedout():
+                    raise ReadTimeout()
+            token, data = self.responses.popleft()
+            # A resend request is followed by its own 'ok'
+            if token != 'Resend:':
+                self.packet_status = 1
+
+    def ascii_checksum(self, line):
+        cs = 0
+        for b in line:
+            cs ^= b
+        return cs
+
+    def stream_ascii(self, lines, rx_buffer_size = DEFAULT_RX_BUFFER_SIZE):
+        # Character counting flow control: keep as many numbered, checksummed lines
+        # in flight as fit in the client RX buffer and match the 'ok's in order.
+        # A 'Resend: N' rewinds the stream to line N. Marlin empties its RX buffer
+        # after a line error, so the lines from N on are never acknowledged and
+        # those still on the wire make it request N again.
+        self.send_ascii("M110 N0")
+
+        source = iter(lines)
+        line_number = 0
+        generation = 0          # bumped on every rewind
+        inflight = deque()      # (line number, packet length)
+        inflight_bytes = 0
+        sent = {}               # line number -> packet, for the last resend_history lines
+        oldest = 1
+        replay = deque()
+        stray_oks = 0           # the 'ok' following each 'Resend:' acknowledges no line
+        rewound_to = None       # line of the last rewind until a replayed line is acknowledged
+        swallowed = None        # TimeOut since a repeated request for rewound_to was ignored
+
+        def next_packet():
+            nonlocal line_number
+            if len(replay):
+                return replay.popleft()
+            for line in source:
+                line = line.split(';', 1)[0].strip()
+                if len(line):
+                    line_number += 1
+                    body = bytearray("N{0} {1}".format(line_number, line), "utf8")
+                    packet = body + bytearray("*{0}\n".format(self.ascii_checksum(body)), "utf8")
+                    sent[line_number] = packet
+                    return line_number, packet
+            return None
+
+        def rewind(n):
+            nonlocal inflight_bytes, generation, replay, rewound_to, swallowed
+            # The client dropped line n and everything after it, only the older lines still get an 'ok'
+            while len(inflight) and inflight[-1][0] >= n:
+                inflight_bytes -= inflight.pop()[1]
+            generation += 1
+            replay = deque((k, sent[k]) for k in range(n, line_number + 1) if k in sent)
+            rewound_to = n
+            swallowed = None
+
+        def process_response():
+            nonlocal inflight_bytes, oldest, stray_oks, rewound_to, swallowed
+            timeout = TimeOut(self.response_timeout * 20)
+            while not len(self.responses):
+                time.sleep(0.00001)
+                if swallowed is not None and swallowed.timedout():
+                    # The ignored request also flushed the replayed lines, nothing else will come
+                    rewind(rewound_to)
+                    return
+                if timeout.timedout():
+                    raise ConnectionLost()
+            token, data = self.responses.popleft()
+            if token == 'ok':
+                if stray_oks:
+                    stray_oks -= 1
+                elif len(inflight):
+                    n, length = inflight.popleft()
+                    inflight_bytes -= length
+                    if rewound_to is not None and n >= rewound_to:
+                        rewound_to = swallowed = None
+                    # An 'ok' doesn't tell a rejected line from an executed one, keep some history
+                    while oldest <= n - self.resend_history:
+                        sent.pop(oldest, None)
+                        oldest += 1
+            elif token == 'Resend:':
+                self.errors += 1
+                stray_oks += 1
+                try:
+                    n = int(data.strip())
+                except ValueError:
+                    return
+                if n not in sent:
+                    return
+                if n == rewound_to:
+                    # Most likely a line sent before the last rewind, still on the wire
+                    swallowed = TimeOut(self.response_timeout)
+                else:
+                    rewind(n)
+
+        packet = None
+        while True:
+            if packet is None:
+                packet = next_packet()
+                if packet is None:
+                    if not len(inflight) and not len(replay) and not stray_oks:
+                        break
+                    process_response()
+                    continue
+            n, data = packet
+            if len(inflight) and inflight_bytes + len(data) > rx_buffer_size:
+                current = generation
+                process_response()
+                if current != generation:
+                    packet = None   # rewound, the replay queue holds this line again
+                continue
+            self.port.write(data)
+            inflight.append((n, len(data)))
+            inflight_bytes += len(data)
+            packet = None
 
     def corrupt_array(self, data):
         rid = random.randint(0, len(data) - 1)
@@ -197,8 +557,8 @@ class Protocol(object):
         return data
 
     def transmit_packet(self, packet):
-        packet = bytearray(packet)
         if(self.simulate_errors > 0 and random.random() > (1.0 - self.simulate_errors)):
+            packet = bytearray(packet)
             if random.random() > 0.9:
                 #random data drop
                 start = random.randint(0, len(packet))
@@ -210,26 +570,33 @@ class Protocol(object):
                 packet = self.corrupt_array(packet)
                 #print("Single byte corruption")
         self.port.write(packet)
+        self.transmit_time = millis()
+        self.metrics.transmitted(len(packet), self.transmit_attempt > 0)
         self.transmit_attempt += 1
 
     def build_packet(self, protocol, packet_type, data = bytearray()):
         PACKET_TOKEN = 0xB5AD
+        length = len(data)
 
-        if len(data) > self.max_block_size:
+        if length > self.max_block_size:
             raise PayloadOverflow()
 
-        packet_buffer = bytearray()
+        # One preallocated buffer per payload size: 16bit start token, 8bit sync id,
+        # 4 bit protocol id + 4 bit packet type, 16bit payload length, 16bit header checksum,
+        # then the payload and its 16bit checksum. The start token is not checksummed.
+        packet_buffer = self.packet_buffers.get(length)
+        if packet_buffer is None:
+            packet_buffer = bytearray(8 + length + (2 if length else 0))
+            self.packet_buffers[length] = packet_buffer
+        view = memoryview(packet_buffer)
 
-        packet_buffer += self.pack_int8(self.sync)                           # 8bit sync id
-        packet_buffer += self.pack_int4_2(protocol, packet_type)             # 4 bit protocol id, 4 bit packet type
-        packet_buffer += self.pack_int16(len(data))                          # 16bit packet length
-        packet_buffer += self.pack_int16(self.build_checksum(packet_buffer)) # 16bit header checksum
+        struct.pack_into('<HBBH', packet_buffer, 0, PACKET_TOKEN, self.sync, ((protocol & 0xF) << 4) | (packet_type & 0xF), length)
+        struct.pack_into('<H', packet_buffer, 6, self.build_checksum(view[2:6]))
 
-        if len(data):
-            packet_buffer += data
-            packet_buffer += self.pack_int16(self.build_checksum(packet_buffer))
+        if length:
+            view[8:8 + length] = data
+            struct.pack_into('<H', packet_buffer, 8 + length, self.build_checksum(view[2:8 + length]))
 
-        packet_buffer =  self.pack_int16(PACKET_TOKEN) + packet_buffer       # 16bit start token, not included in checksum
         return packet_buffer
 
     # checksum 16 fletchers
@@ -270,23 +637,35 @@ class Protocol(object):
             packet_id = int(data);
         except ValueError:
             return
+        if packet_id == (self.sync - 1) % 256:
+            return  # late or repeated acknowledgement of the previous packet
         if packet_id != self.sync:
             raise SycronisationError()
         self.sync = (self.sync + 1) % 256
         self.packet_status = 1
 
     def response_resend(self, data):
-        packet_id = int(data);
         self.errors += 1
+        try:
+            packet_id = int(data);
+        except ValueError:
+            return
+        self.metrics.resends += 1
         if not self.syncronised:
             print("Retrying syncronisation")
+        elif packet_id == (self.sync - 1) % 256:
+            pass    # late request for the previous packet, it was acknowledged since
         elif packet_id != self.sync:
             raise SycronisationError()
 
     def response_stream_sync(self, data):
-        sync, max_block_size, protocol_version = data.split(',')
-        self.sync = int(sync)
-        self.max_block_size = int(max_block_size)
+        try:
+            sync, max_block_size, protocol_version = data.split(',')
+            sync, max_block_size = int(sync), int(max_block_size)
+        except ValueError:
+            return  # mangled, the SYNC packet is sent again after the timeout
+        self.sync = sync
+        self.max_block_size = max_block_size
         self.block_size = self.max_block_size if self.max_block_size < self.block_size else self.block_size
         self.protocol_version = protocol_version
         self.packet_status = 1
@@ -296,6 +675,296 @@ class Protocol(object):
     def response_fatal_error(self, data):
         raise FatalError()
 
+    def response_resend_ascii(self, data):
+        # Only sent by the ASCII command parser, nothing to do in binary mode
+        pass
+
+
+class BlockStream(object):
+    """Read the source file through a memory map and compress it in a worker thread,
+    handing chunks to the sender through a bounded queue so that compression and
+    transmission overlap and memory use stays flat."""
+    read_size = 16384
+    queue_depth = 8
+
+    def __init__(self, filename, compression = None, offset = 0):
+        self.file = open(filename, "rb")
+        self.filesize = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ) if self.filesize else b''
+        self.compression = compression
+        self.chunks = queue.Queue(self.queue_depth)
+        self.stopped = threading.Event()
+        self.offset = offset    # source offset the stream starts at
+        self.bytes_in = offset  # source bytes handed to the sender
+        self.bytes_out = 0      # (compressed) bytes handed to the sender
+        self.worker_thread = threading.Thread(target=BlockStream.producer, args=(self,), daemon=True)
+        self.worker_thread.start()
+
+    def new_encoder(self):
+        window, lookahead = self.compression['window'], self.compression['lookahead']
+        if heatshrink_bundled:
+            return heatshrink.Encoder(window_sz2=window, lookahead_sz2=lookahead)
+        if hasattr(heatshrink, 'Encoder') and hasattr(heatshrink, 'Writer'):
+            return heatshrink.Encoder(heatshrink.Writer(window_sz2=window, lookahead_sz2=lookahead))
+        return WholeBufferEncoder(window, lookahead)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def producer(self):
+        try:
+            encoder = self.new_encoder() if self.compression else None
+            view = memoryview(self.data) if self.filesize else b''
+            for offset in range(self.offset, self.filesize, self.read_size):
+                if self.stopped.is_set():
+                    return
+                end = min(offset + self.read_size, self.filesize)
+                # The encoder reads the mapped slice in place, a raw chunk is copied
+                # once as it outlives the map
+                self.put(((encoder.fill(view[offset:end]) if encoder else bytes(view[offset:end])), end))
+            if encoder:
+                self.put((encoder.finish(), self.filesize))
+            del view
+            self.put(None)
+        except Exception as ex:
+            self.put(ex)
+
+    def blocks(self, block_size):
+        # block_size may be a callable so the sender can resize blocks mid-stream.
+        # Blocks are memoryview slices of the queued chunks, only a block that
+        # straddles two chunks is copied.
+        next_size = block_size if callable(block_size) else lambda: block_size
+        view, pending = memoryview(b''), None
+        done = False
+        while True:
+            block_size = next_size()
+            while len(view) < block_size and not done:
+                if pending is None:
+                    item = self.chunks.get()
+                    if item is None:
+                        done = True
+                        break
+                    elif isinstance(item, Exception):
+                        raise item
+                    chunk, self.bytes_in = item
+                    pending = memoryview(chunk)
+                if not len(view):
+                    view, pending = pending, None
+                else:
+                    need = block_size - len(view)
+                    view = memoryview(view.tobytes() + pending[:need].tobytes())
+                    pending = pending[need:] if len(pending) > need else None
+            if not len(view):
+                return
+            block, view = view[:block_size], view[block_size:]
+            self.bytes_out += len(block)
+            yield block
+
+    def ratio(self):
+        return (self.bytes_in - self.offset) / self.bytes_out if self.bytes_out else 1.0
+
+    def close(self):
+        self.stopped.set()
+        self.worker_thread.join()
+        if self.filesize:
+            self.data.close()
+        self.file.close()
+
+
+class WholeBufferEncoder(object):
+    """Fallback for heatshrink builds without an incremental encoder: the stream is
+    still produced on the worker thread, but only once all of the input has been seen."""
+    def __init__(self, window, lookahead):
+        self.window = window
+        self.lookahead = lookahead
+        self.buffer = bytearray()
+
+    def fill(self, data):
+        self.buffer += data
+        return b''
+
+    def finish(self):
+        return heatshrink.encode(bytes(self.buffer), window_sz2=self.window, lookahead_sz2=self.lookahead)
+
+
+class TransferJournal(object):
+    """Host side record of the source offset the client has acknowledged, so a
+    broken transfer can be continued instead of restarted. The journal is only
+    valid for the same source content and target filename."""
+    checkpoint_interval = 65536
+
+    def __init__(self, filename, dest_filename, path = None):
+        self.path = path or filename + ".resume"
+        self.dest_filename = dest_filename
+        self.source_hash = self.hash_file(filename)
+        self.offset = 0
+        self.saved_offset = 0
+
+    @staticmethod
+    def hash_file(filename):
+        sha256_hash = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for byte_block in iter(lambda: f.read(65536), b""):
+                sha256_hash.update(byte_block)
+        return sha256_hash.hexdigest()
+
+    def load(self):
+        try:
+            with open(self.path) as infile:
+                entry = json.load(infile)
+            if entry['sha256'] == self.source_hash and entry['dest'] == self.dest_filename:
+                self.offset = self.saved_offset = int(entry['offset'])
+        except (OSError, ValueError, KeyError):
+            self.offset = self.saved_offset = 0
+        return self.offset
+
+    def acknowledge(self, offset):
+        self.offset = offset
+        if self.offset - self.saved_offset >= self.checkpoint_interval:
+            self.save()
+
+    def save(self):
+        with open(self.path, "w") as outfile:
+            json.dump({'sha256': self.source_hash, 'dest': self.dest_filename, 'offset': self.offset}, outfile)
+        self.saved_offset = self.offset
+
+    def finish(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def reset(self):
+        self.offset = self.saved_offset = 0
+        self.finish()
+
+
+class UploadCache(object):
+    """Host side record of the files each device already holds, keyed by device and
+    target filename with the SHA-256 and size of what was sent. An entry only counts
+    while the device still lists the file (M20) with the same size."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as infile:
+                self.entries = json.load(infile)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def parse_listing(lines):
+        # M20 lines are 'SHORTNAME SIZE [LONGNAME]', index both names
+        files = {}
+        for line in lines:
+            fields = line.split(' ', 2)
+            if len(fields) < 2 or not fields[1].isdigit():
+                continue
+            for name in [fields[0]] + fields[2:]:
+                files[name.lstrip('/').upper()] = int(fields[1])
+        return files
+
+    def is_current(self, device, filename, sha256, listing):
+        with self.lock:
+            entry = self.entries.get(device, {}).get(filename.upper())
+        if not entry or entry['sha256'] != sha256:
+            return False
+        return self.parse_listing(listing).get(filename.upper()) == entry['size']
+
+    def record(self, device, filename, sha256, size):
+        with self.lock:
+            self.entries.setdefault(device, {})[filename.upper()] = {'sha256': sha256, 'size': size}
+            self.save()
+
+    def forget(self, device, filename):
+        with self.lock:
+            if self.entries.get(device, {}).pop(filename.upper(), None):
+                self.save()
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as outfile:
+            json.dump(self.entries, outfile, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+class AdaptiveTransfer(object):
+    """Tune the payload size from the measured per-block RTT and the resend count
+    reported through Protocol.errors, and decide whether compression pays off
+    on this link. Errors shrink the block, a run of clean blocks grows it again."""
+    min_block_size = 64
+    grow_after = 16         # clean blocks needed before growing the payload
+    window = 32             # blocks considered for the error rate
+    max_error_rate = 0.5    # give up when worse than this at the minimum block size
+    probe_blocks = 4
+    sample_size = 65536
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.max_block_size = protocol.max_block_size
+        self.block_size = max(min(protocol.block_size, self.max_block_size), self.min_block_size)
+        self.link_rate = 0      # bytes per second, measured by probe()
+        self.rtt = 0            # smoothed round trip time per block, ms
+        self.clean_blocks = 0
+        self.history = deque(maxlen=self.window)
+        self.last_errors = protocol.errors
+
+    def probe(self, filetransfer):
+        # Push a few full size blocks through a dummy transfer to measure the raw link speed
+        payload = bytes(self.max_block_size)
+        filetransfer.open("probe.bin", False, True)
+        start_time = millis()
+        for i in range(self.probe_blocks):
+            filetransfer.write(payload)
+        elapsed = max(millis() - start_time, 1)
+        filetransfer.close()
+        self.link_rate = (self.probe_blocks * len(payload)) / elapsed * 1000
+        self.rtt = elapsed / self.probe_blocks
+        self.last_errors = self.protocol.errors
+        print("Link probe: {0:4.2f}KiB/s, {1:4.2f}ms per block".format(self.link_rate / 1024, self.rtt))
+
+    def use_compression(self, filename, settings):
+        # Compression and transmission overlap, so compressing wins when the encoder
+        # keeps ahead of the link and the compressed stream is shorter than the source
+        with open(filename, "rb") as f:
+            sample = f.read(self.sample_size)
+        if not len(sample) or not self.link_rate:
+            return True
+        start_time = time.perf_counter()
+        encoded = heatshrink.encode(sample, window_sz2=settings['window'], lookahead_sz2=settings['lookahead'])
+        encode_rate = len(sample) / max(time.perf_counter() - start_time, 1e-6)
+        ratio = len(sample) / max(len(encoded), 1)
+        compressed_time = max(1 / encode_rate, 1 / (ratio * self.link_rate))
+        raw_time = 1 / self.link_rate
+        print("Compression ratio {0:4.2f}, encoder {1:4.2f}KiB/s: {2}".format(ratio, encode_rate / 1024, "enabled" if compressed_time < raw_time else "disabled"))
+        return compressed_time < raw_time
+
+    def update(self, rtt):
+        errors = self.protocol.errors - self.last_errors
+        self.last_errors = self.protocol.errors
+        self.rtt = rtt if not self.rtt else self.rtt * 0.9 + rtt * 0.1
+        self.history.append(1 if errors else 0)
+        if errors:
+            self.clean_blocks = 0
+            self.block_size = max(self.block_size // 2, self.min_block_size)
+        else:
+            self.clean_blocks += 1
+            if self.clean_blocks >= self.grow_after and self.block_size < self.max_block_size:
+                self.clean_blocks = 0
+                self.block_size = min(self.block_size * 2, self.max_block_size)
+
+    def error_rate(self):
+        return sum(self.history) / len(self.history) if len(self.history) else 0
+
+    def failed(self):
+        return (self.block_size == self.min_block_size and len(self.history) == self.window
+                and self.error_rate() > self.max_error_rate)
+
 
 class FileTransferProtocol(object):
     protocol_id = 1
@@ -307,8 +976,10 @@ class FileTransferProtocol(object):
         WRITE = 3
         ABORT = 4
 
-    responses = deque()
+    responses = None
+    transferred_size = 0    # size of the file on the client after the last copy()
     def __init__(self, protocol, timeout = None):
+        self.responses = deque()
         protocol.register(['PFT:success', 'PFT:version:', 'PFT:fail', 'PFT:busy', 'PFT:ioerror', 'PTF:invalid'], self.process_input)
         self.protocol = protocol
         self.response_timeout = timeout or protocol.response_timeout
@@ -342,9 +1013,20 @@ class FileTransferProtocol(object):
 
         print("File Transfer version: {0}, compression: {1}".format(self.version, self.compression['algorithm']))
 
-    def open(self, filename, compression, dummy):
-        payload =  b'\1' if dummy else b'\0'          # dummy transfer
+    def supports_resume(self):
+        # Re-opening a file at an offset was added in file transfer protocol 0.2
+        try:
+            return tuple(int(v) for v in self.version.split('.')[:2]) >= (0, 2)
+        except (AttributeError, ValueError):
+            return False
+
+    def open(self, filename, compression, dummy, offset = None):
+        flags = 1 if dummy else 0                     # dummy transfer
+        flags |= 2 if offset is not None else 0       # resumable, re-open at offset
+        payload =  bytearray([flags])
         payload += b'\1' if compression else b'\0'    # payload compression
+        if offset is not None:
+            payload += offset.to_bytes(4, byteorder='little')
         payload += bytearray(filename, 'utf8') + b'\0'# target filename + null terminator
 
         timeout = TimeOut(5000)
@@ -357,13 +1039,18 @@ class FileTransferProtocol(object):
                     print(filename,"opened")
                     return
                 elif token == 'PFT:busy':
-                    print("Broken transfer detected, purging")
-                    self.abort()
+                    if offset is not None:
+                        # Aborting would delete the partial file this transfer continues
+                        print("Broken transfer detected, closing")
+                        self.close()
+                    else:
+                        print("Broken transfer detected, purging")
+                        self.abort()
                     time.sleep(0.1)
                     self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload);
                     timeout.reset()
                 elif token == 'PFT:fail':
-                    raise Exception("Can not open file on client")
+                    raise OpenError("Can not open file on client")
             except ReadTimeout:
                 pass
         raise ReadTimeout()
@@ -390,53 +1077,142 @@ class FileTransferProtocol(object):
         if token == 'PFT:success':
             print("Transfer Aborted")
 
-    def copy(self, filename, dest_filename, compression, dummy):
+    def write_retry(self, data, retries):
+        for attempt in range(retries):
+            try:
+                self.write(data)
+                return
+            except (ReadTimeout, ConnectionLost):
+                self.protocol.errors += 1
+                if attempt == retries - 1:
+                    raise
+
+    def copy(self, filename, dest_filename, compression, dummy, adaptive = False, retries = 3, resume = False, compact = None):
+        if compact is not None:
+            # Send a compacted copy of a G-code job, compact holds the GcodeCompactor options.
+            # The copy is regenerated identically on every run, so a resume journal stays valid
+            compacted = filename + ".compact"
+            size_in, size_out = gcode_compact.compact_file(filename, compacted, **compact)
+            print("Compacted {0} to {1} bytes ({2:4.1f}%)".format(size_in, size_out, 100.0 * size_out / max(size_in, 1)))
+            try:
+                return self.copy(compacted, dest_filename, compression, dummy, adaptive, retries, resume)
+            finally:
+                os.remove(compacted)
+
         self.connect()
 
+        journal = None
+        if resume and not dummy:
+            if self.supports_resume():
+                journal = TransferJournal(filename, dest_filename)
+            else:
+                print("Resume not supported by client")
+
         compression_support = heatshrink_exists and self.compression['algorithm'] == 'heatshrink' and compression
         if compression and (not heatshrink_exists or not self.compression['algorithm'] == 'heatshrink'):
             print("Compression not supported by client")
         #compression_support = False
 
-        data = open(filename, "rb").read()
-        filesize = len(data)
-
-        self.open(dest_filename, compression_support, dummy)
-
-        block_size = self.protocol.block_size
-        if compression_support:
-            data = heatshrink.encode(data, window_sz2=self.compression['window'], lookahead_sz2=self.compression['lookahead'])
-
-        cratio = filesize / len(data)
+        controller = AdaptiveTransfer(self.protocol) if adaptive else None
+        metrics = self.protocol.metrics
+        if controller:
+            with metrics.phase('probe'):
+                controller.probe(self)
+            if compression_support:
+                compression_support = controller.use_compression(filename, self.compression)
+
+        offset = None
+        if journal:
+            # Acknowledged offsets are only byte exact for the raw stream
+            if compression_support:
+                print("Resumable transfers are sent uncompressed")
+                compression_support = False
+            offset = journal.load()
+            if offset:
+                print("Resuming transfer at {0} bytes".format(offset))
+
+        with metrics.phase('open'):
+            try:
+                self.open(dest_filename, compression_support, dummy, offset)
+            except OpenError:
+                if not offset:
+                    raise
+                # The partial file is gone or shorter than the journal says, start over
+                print("Can not resume, restarting the transfer")
+                journal.reset()
+                offset = 0
+                self.open(dest_filename, compression_support, dummy, offset)
+
+        block_size = (lambda: controller.block_size) if controller else self.protocol.block_size
+        stream = BlockStream(filename, self.compression if compression_support else None, offset or 0)
+        filesize = stream.filesize
+        completed = False
 
-        blocks = math.floor((len(data) + block_size - 1) / block_size)
-        kibs = 0
-        dump_pctg = 0
         start_time = millis()
-        for i in range(blocks):
-            start = block_size * i
-            end = start + block_size
-            self.write(data[start:end])
-            kibs = (( (i+1) * block_size) / 1024) / (millis() + 1 - start_time) * 1000
-            if (i / blocks) >= dump_pctg:
-                print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}".format((i / blocks) * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression_support else "", self.protocol.errors), end='')
-                dump_pctg += 0.1
-            if self.protocol.errors > 0:
-                # Dump last status (errors may not be visible)
-                print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3} - Aborting...".format((i / blocks) * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression_support else "", self.protocol.errors), end='')
-                print("")   # New line to break the transfer speed line
-                self.close()
-                print("Transfer aborted due to protocol errors")
-                #raise Exception("Transfer aborted due to protocol errors")
-                return False;
-        print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}".format(100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression_support else "", self.protocol.errors)) # no one likes transfers finishing at 99.8%
-
-        if not self.close():
+        try:
+            kibs = 0
+            dump_pctg = 0
+            for block in stream.blocks(block_size):
+                block_time = millis()
+                if controller:
+                    self.write_retry(block, retries)
+                    controller.update(millis() - block_time)
+                else:
+                    self.write(block)
+                if journal:
+                    journal.acknowledge(stream.offset + stream.bytes_out)
+                progress = stream.bytes_in / filesize if filesize else 1.0
+                kibs = (stream.bytes_out / 1024) / (millis() + 1 - start_time) * 1000
+                cratio = stream.ratio()
+                if progress >= dump_pctg:
+                    print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}".format(progress * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression_support else "", self.protocol.errors), end='')
+                    dump_pctg += 0.1
+                if (controller.failed() if controller else self.protocol.errors > 0):
+                    # Dump last status (errors may not be visible)
+                    print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3} - Aborting...".format(progress * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression_support else "", self.protocol.errors), end='')
+                    print("")   # New line to break the transfer speed line
+                    self.close()
+                    print("Transfer aborted due to protocol errors")
+                    #raise Exception("Transfer aborted due to protocol errors")
+                    return False;
+            completed = True
+        finally:
+            metrics.add_phase('stream', millis() - start_time)
+            metrics.streamed(stream.bytes_in, stream.bytes_out)
+            stream.close()
+            if journal and not completed:
+                journal.save()
+        print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}".format(100, kibs, "[{0:4.2f}KiB/s]".format(kibs * stream.ratio()) if compression_support else "", self.protocol.errors)) # no one likes transfers finishing at 99.8%
+
+        with metrics.phase('close'):
+            closed = self.close()
+        if not closed:
             print("Transfer failed")
+            if journal:
+                journal.save()
             return False
+        if journal:
+            journal.finish()
+        self.transferred_size = filesize
         print("Transfer complete")
         return True
 
+    def sync(self, files, device, cache, listing, compression, hash_file = TransferJournal.hash_file, **kwargs):
+        # Copy only the (source, target) pairs the device doesn't already hold
+        sent, skipped, failed = [], [], []
+        for filename, dest_filename in files:
+            sha256 = hash_file(filename)
+            if cache.is_current(device, dest_filename, sha256, listing):
+                print(dest_filename, "is up to date")
+                skipped.append(dest_filename)
+            elif self.copy(filename, dest_filename, compression, False, **kwargs):
+                cache.record(device, dest_filename, sha256, self.transferred_size)
+                sent.append(dest_filename)
+            else:
+                cache.forget(device, dest_filename)
+                failed.append(dest_filename)
+        return sent, skipped, failed
+
 
 class EchoProtocol(object):
     def __init__(self, protocol):
@@ -445,3 +1221,67 @@ class EchoProtocol(object):
 
     def process_input(self, data):
         print(data)
+
+
+class TelemetryProtocol(object):
+    """Collect the firmware auto-reports (M154 position, M155 temperatures) into a
+    ring buffer of timestamped samples. The firmware pushes the reports, so there
+    is no polling traffic competing with the job stream. Auto-reporting is an ASCII
+    command: call enable() before switching to the binary protocol."""
+    POSITION = 'position'
+    TEMPERATURE = 'temperature'
+
+    def __init__(self, protocol, capacity = 600):
+        protocol.register(['X:'], self.process_position)
+        protocol.register([' T:', ' B:', ' C:', ' P:', ' L:', ' M:', ' R:'], self.process_temperature)
+        self.protocol = protocol
+        self.samples = deque(maxlen=capacity)   # (timestamp, kind, values)
+        self.last = {}
+
+    def enable(self, interval = 1):
+        # The firmware takes whole seconds, 0 disables the report
+        self.protocol.send_ascii("M154 S{0}".format(int(interval)))
+        self.protocol.send_ascii("M155 S{0}".format(int(interval)))
+
+    def disable(self):
+        self.enable(0)
+
+    def record(self, kind, values):
+        sample = (time.time(), kind, values)
+        self.samples.append(sample)
+        self.last[kind] = sample
+
+    def process_position(self, data):
+        # X:0.00 Y:0.00 Z:0.00 E:0.00 Count X:0 Y:0 Z:0
+        token, data = data
+        values = {}
+        for field in (token + data).split(' Count')[0].split():
+            axis, _, value = field.partition(':')
+            try:
+                values[axis] = float(value)
+            except ValueError:
+                return
+        self.record(TelemetryProtocol.POSITION, values)
+
+    def process_temperature(self, data):
+        # T:25.00 /0.00 B:25.00 /0.00 @:0 B@:0, the target follows the current temperature
+        token, data = data
+        values = {}
+        sensor = None
+        for field in (token + data).split():
+            try:
+                if field[0] == '/' and sensor:
+                    values[sensor] = (values[sensor], float(field[1:]))
+                else:
+                    sensor, _, value = field.partition(':')
+                    values[sensor] = float(value)
+            except ValueError:
+                return
+        self.record(TelemetryProtocol.TEMPERATURE, values)
+
+    def latest(self, kind):
+        return self.last.get(kind)
+
+    def history(self, kind = None, since = 0):
+        return [s for s in list(self.samples) if s[0] >= since and (kind is None or s[1] == kind)]
+
@@ -0,0 +1,184 @@
+#
+# ascii_stream_check.py
+# Check Protocol.stream_ascii against an in-process model of the Marlin serial
+# command reader (Marlin/src/gcode/queue.cpp).
+#
+# LoopbackMarlin keeps the received bytes in an RX buffer of rx_buffer_size,
+# moves lines into a short command queue and answers 'ok' once a command has
+# run. After a bad checksum or line number it replies 'Resend: N' + 'ok' and
+# empties its RX buffer like gcode_line_error, so the lines behind the bad one
+# are lost and those still on the wire cause more requests for N. Lines are
+# corrupted by a seeded generator, a run can be repeated:
+#   python ascii_stream_check.py --lines 5000 --error-rate 0.02 --seed 3
+#   python ascii_stream_check.py --corrupt 100 --corrupt 101
+# The check fails if the lines executed differ from the stream, the RX buffer
+# overflows or the stream takes longer than --max-seconds.
+#
+import argparse
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+from MarlinBinaryProtocol import ConnectionLost, millis
+from binary_protocol_soak import LoopbackPipe, LoopbackPort, SoakProtocol
+
+class LoopbackMarlin(object):
+    """Client side of the ASCII stream: RX buffer, line checks and command queue"""
+    def __init__(self, port, rx_buffer_size, latency = 2, exec_time = 0.5, queue_size = 4,
+                 error_rate = 0.0, corrupt = (), seed = 0):
+        self.port = port
+        self.rx_buffer_size = rx_buffer_size
+        self.latency = latency          # ms on the wire
+        self.exec_time = exec_time      # ms per command
+        self.queue_size = queue_size    # BUFSIZE
+        self.error_rate = error_rate
+        self.corrupt = set(corrupt)     # line numbers damaged on their first transmission
+        self.random = random.Random(seed)
+        self.partial = b''
+        self.wire = deque()             # (arrival time, line)
+        self.rx = deque()
+        self.rx_bytes = 0
+        self.rx_max = 0
+        self.overflows = 0
+        self.queue = deque()
+        self.busy_until = 0
+        self.last_n = 0
+        self.executed = []
+        self.resends = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def reply(self, text):
+        self.port.write(bytes(text + "\n", "utf8"))
+
+    def damage(self, line):
+        try:
+            n = int(line[1:line.index(b' ')]) if line.startswith(b'N') else None
+        except ValueError:
+            n = None
+        if n in self.corrupt:
+            self.corrupt.discard(n)
+        elif self.random.random() >= self.error_rate:
+            return line
+        line = bytearray(line)
+        line[self.random.randrange(1, len(line) - 1)] ^= 0x01     # a damaged N would make it an unnumbered command
+        return bytes(line)
+
+    def receive(self, now):
+        *lines, self.partial = (self.partial + self.port.read(4096)).split(b'\n')
+        for line in lines:
+            self.wire.append((now + self.latency, self.damage(line + b'\n')))
+        while len(self.wire) and self.wire[0][0] <= now:
+            line = self.wire.popleft()[1]
+            self.rx.append(line)
+            self.rx_bytes += len(line)
+            self.rx_max = max(self.rx_max, self.rx_bytes)
+            if self.rx_bytes > self.rx_buffer_size:
+                self.overflows += 1
+            # The main loop reads each line as it comes in while the command queue has room
+            self.read_commands()
+
+    def line_error(self):
+        self.resends += 1
+        self.reply("Error:checksum mismatch, Last Line: %d" % self.last_n)
+        self.rx.clear()         # Clear out the RX buffer
+        self.rx_bytes = 0
+        self.reply("Resend: %d" % (self.last_n + 1))
+        self.reply("ok")
+
+    def read_commands(self):
+        while len(self.rx) and len(self.queue) < self.queue_size:
+            self.read_command()
+
+    def read_command(self):
+        line = self.rx.popleft()
+        self.rx_bytes -= len(line)
+        command = line.decode('utf8', 'replace').strip()
+        if command.startswith('N'):
+            body, star, checksum = command.rpartition('*')
+            try:
+                n = int(body[1:].split(' ', 1)[0])
+                valid = star and int(checksum) == self.checksum(body)
+            except ValueError:
+                valid = False
+            if not valid or n != self.last_n + 1:
+                self.line_error()
+                return
+            self.last_n = n
+            command = body.split(' ', 1)[1]
+        elif command.startswith('M110'):
+            self.last_n = 0
+        self.queue.append(command)
+
+    @staticmethod
+    def checksum(body):
+        cs = 0
+        for b in bytes(body, 'utf8'):
+            cs ^= b
+        return cs
+
+    def run(self):
+        while self.running:
+            now = millis()
+            self.receive(now)
+            if len(self.queue) and now >= self.busy_until:
+                self.executed.append(self.queue.popleft())
+                self.reply("ok")
+                self.busy_until = now + self.exec_time
+            self.read_commands()
+
+def main():
+    parser = argparse.ArgumentParser(description="Check ASCII streaming against a Marlin that drains its RX buffer on errors")
+    parser.add_argument('--lines', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.01, help='chance a line is damaged')
+    parser.add_argument('--corrupt', type=int, action='append', default=[], metavar='N', help='damage line N once')
+    parser.add_argument('--latency', type=float, default=2, help='ms on the wire')
+    parser.add_argument('--exec-time', type=float, default=0.5, help='ms per command')
+    parser.add_argument('--rx-buffer', type=int, default=128)
+    parser.add_argument('--queue-size', type=int, default=1, help='commands buffered by the client (BUFSIZE), a short queue keeps more lines in the RX buffer')
+    parser.add_argument('--timeout', type=int, default=250, help='response timeout, ms')
+    parser.add_argument('--max-seconds', type=float, default=60)
+    args = parser.parse_args()
+
+    to_client, to_host = LoopbackPipe(), LoopbackPipe()
+    client = LoopbackMarlin(LoopbackPort(to_client, to_host, timeout = 0.0005), args.rx_buffer, args.latency, args.exec_time,
+                            args.queue_size, error_rate = args.error_rate, corrupt = args.corrupt, seed = args.seed)
+    protocol = SoakProtocol(LoopbackPort(to_host, to_client, timeout = 0.01), 512, args.timeout)
+    lines = [ "G1 X%d Y%d F%d ; move %d" % (i % 200, (i * 7) % 200, 1000 + i % 3000, i) for i in range(args.lines) ]
+
+    start = time.time()
+    try:
+        protocol.stream_ascii(lines, args.rx_buffer)
+        result = "complete"
+    except ConnectionLost:
+        result = "connection lost"
+    finally:
+        elapsed = time.time() - start
+        protocol.shutdown()
+        client.stop()
+
+    expected = [ line.split(';', 1)[0].strip() for line in lines ]
+    executed = client.executed[1:]      # after M110
+    print("%s in %.2f s: %d of %d lines, %d resend requests, %d host errors, RX buffer peak %d of %d bytes"
+          % (result, elapsed, len(executed), len(expected), client.resends, protocol.errors, client.rx_max, args.rx_buffer))
+    failures = []
+    if executed != expected:
+        failures.append("executed lines differ from the stream")
+    if client.overflows:
+        failures.append("RX buffer overflowed %d times" % client.overflows)
+    if elapsed > args.max_seconds:
+        failures.append("took longer than %g s" % args.max_seconds)
+    for failure in failures:
+        print("FAIL: " + failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#
+# binary_protocol_alloc_check.py
+# Check that Protocol.build_packet does not allocate per packet.
+#
+# build_packet fills one preallocated buffer per payload size, so once every
+# size has been seen, building more packets must not grow the traced memory.
+# The check builds packets of a few block sizes under tracemalloc and fails if
+# the memory still allocated afterwards, or the peak while building, grows
+# with the number of packets:
+#   python binary_protocol_alloc_check.py --packets 20000 --block-size 512
+#
+import argparse
+import struct
+import sys
+import tracemalloc
+
+from binary_protocol_soak import LoopbackPipe, LoopbackPort, SoakProtocol
+
+def reference_packet(protocol, packet_type, data, sync):
+    """The packet as the firmware expects it, built the straightforward way"""
+    header = struct.pack('<BBH', sync, ((1 & 0xF) << 4) | (packet_type & 0xF), len(data))
+    header += struct.pack('<H', protocol.build_checksum(header))
+    if data:
+        return struct.pack('<H', 0xB5AD) + header + data + struct.pack('<H', protocol.build_checksum(header + data))
+    return struct.pack('<H', 0xB5AD) + header
+
+def build_packets(protocol, payloads, count):
+    for i in range(count):
+        protocol.sync = i % 256
+        protocol.build_packet(1, 2, payloads[i % len(payloads)])
+
+def measure(protocol, payloads, count):
+    """Memory still allocated after count packets and the peak while building them"""
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        build_packets(protocol, payloads, count)
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return after - before, peak - before
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that build_packet does not allocate per packet")
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--slack', type=int, default=1024, help='bytes of growth tolerated between the runs')
+    args = parser.parse_args()
+
+    protocol = SoakProtocol(LoopbackPort(LoopbackPipe(), LoopbackPipe(), timeout = 0.01), args.block_size, 250)
+    try:
+        protocol.max_block_size = args.block_size
+        sizes = sorted({ 0, 1, args.block_size // 2, args.block_size })
+        payloads = [ bytes((i * 7 + n) & 0xFF for i in range(n)) for n in sizes ]
+
+        for data in payloads:
+            if bytes(protocol.build_packet(1, 2, data)) != reference_packet(protocol, 2, data, protocol.sync):
+                print("build_packet output differs from the reference for a %d byte payload" % len(data))
+                return 1
+
+        build_packets(protocol, payloads, len(payloads))     # every buffer exists from here on
+        short_kept, short_peak = measure(protocol, payloads, args.packets // 10)
+        long_kept, long_peak = measure(protocol, payloads, args.packets)
+    finally:
+        protocol.shutdown()
+
+    print("%8d packets: %6d bytes kept, %6d bytes peak" % (args.packets // 10, short_kept, short_peak))
+    print("%8d packets: %6d bytes kept, %6d bytes peak" % (args.packets, long_kept, long_peak))
+    per_packet = max(long_kept - short_kept, long_peak - short_peak) / (args.packets - args.packets // 10)
+    if long_kept - short_kept > args.slack or long_peak - short_peak > args.slack:
+        print("FAIL: %.2f bytes per packet" % per_packet)
+        return 1
+    print("OK: allocations per packet are flat")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,488 @@
+#
+# binary_protocol_soak.py
+# Fault injection for the binary file transfer protocol and a soak test runner.
+#
+# FaultyPort wraps the serial port of a Protocol and damages both directions:
+# bit flips, lost bytes, lost / duplicated / late 'ok' lines and bursts of loss
+# (Gilbert-Elliott model). All decisions come from seeded generators, one per
+# direction, so a run can be repeated; only retransmissions triggered by a
+# timeout still depend on timing.
+#
+# The soak test streams dummy WRITE packets through a FaultyPort and reports the
+# goodput and the time the protocol needs to recover from each fault:
+#   python binary_protocol_soak.py --bytes 1G --profile shop --seed 7
+#   python binary_protocol_soak.py --port /dev/ttyUSB0 --bytes 64M
+# Without --port it runs against LoopbackClient, an in-process model of the
+# firmware side (Marlin/src/feature/binary_stream.h).
+#
+import argparse
+import heapq
+import math
+import random
+import threading
+import time
+
+import MarlinBinaryProtocol
+from MarlinBinaryProtocol import millis
+
+class FaultProfile(object):
+    """Fault rates, per write for the host to client direction and per line for
+    the responses. Bit errors apply to both."""
+    bit_error_rate = 0.0        # per bit
+    drop_rate = 0.0             # a write loses 1..max_drop bytes
+    max_drop = 10
+    line_drop_rate = 0.0        # a response line is lost
+    duplicate_ok_rate = 0.0     # an 'ok' arrives twice
+    delay_ok_rate = 0.0         # an 'ok' arrives late, possibly after later lines
+    delay_ok = (10, 300)        # ms
+    burst_start = 0.0           # Gilbert-Elliott: chance to enter a burst, per write / line
+    burst_end = 0.0             # chance to leave it
+    burst_loss = 0.0            # chance a write / line is lost during a burst
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(FaultProfile, key):
+                raise ValueError("Unknown fault: {0}".format(key))
+            setattr(self, key, value)
+
+PROFILES = {
+    'clean': {},
+    'noisy': {'bit_error_rate': 1e-5, 'drop_rate': 0.002, 'line_drop_rate': 0.002, 'duplicate_ok_rate': 0.002, 'delay_ok_rate': 0.002},
+    # Spindle and VFD noise in the shop: mostly clean, with bursts that take out a few packets in a row
+    'shop': {'bit_error_rate': 2e-6, 'drop_rate': 0.001, 'line_drop_rate': 0.001, 'duplicate_ok_rate': 0.001, 'delay_ok_rate': 0.005,
+             'burst_start': 0.002, 'burst_end': 0.2, 'burst_loss': 0.6},
+}
+
+class BurstState(object):
+    def __init__(self, profile):
+        self.profile = profile
+        self.active = False
+
+    def lost(self, rnd):
+        if self.active:
+            self.active = rnd.random() >= self.profile.burst_end
+        elif self.profile.burst_start:
+            self.active = rnd.random() < self.profile.burst_start
+        return self.active and rnd.random() < self.profile.burst_loss
+
+class FaultyPort(object):
+    """Serial port wrapper injecting the faults of a FaultProfile. Anything not
+    overridden here is passed to the wrapped port."""
+    def __init__(self, port, profile, seed = 0):
+        self.port = port
+        self.profile = profile
+        self.tx_random = random.Random(seed * 2)
+        self.rx_random = random.Random(seed * 2 + 1)
+        self.tx_burst = BurstState(profile)
+        self.rx_burst = BurstState(profile)
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.faults = {}
+        self.fault_time = None      # first fault not yet followed by an 'ok'
+        self.recovery = []          # ms from a fault to the next 'ok' that got through
+        self.delayed = []           # heap of (release time, sequence, line)
+        self.sequence = 0
+        self.duplicates = []
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def fault(self, kind):
+        with self.lock:
+            self.faults[kind] = self.faults.get(kind, 0) + 1
+            if self.fault_time is None:
+                self.fault_time = millis()
+
+    def flip_bits(self, rnd, data):
+        # Jump from error to error with geometric gaps instead of drawing once per bit
+        ber = self.profile.bit_error_rate
+        if not ber:
+            return False
+        bits = len(data) * 8
+        pos = -1
+        flipped = False
+        while True:
+            pos += 1 + int(math.log(1.0 - rnd.random()) / math.log(1.0 - ber))
+            if pos >= bits:
+                return flipped
+            data[pos >> 3] ^= 1 << (pos & 7)
+            flipped = True
+
+    def write(self, data):
+        length = len(data)
+        if not self.enabled:
+            return self.port.write(data)
+        rnd, profile = self.tx_random, self.profile
+        if self.tx_burst.lost(rnd):
+            self.fault('tx_burst_loss')
+            return length
+        data = bytearray(data)
+        if rnd.random() < profile.drop_rate:
+            start = rnd.randrange(len(data))
+            del data[start:start + rnd.randint(1, profile.max_drop)]
+            self.fault('tx_drop')
+        if self.flip_bits(rnd, data):
+            self.fault('tx_bit_flip')
+        self.port.write(data)
+        return length
+
+    def deliver(self, line):
+        if line.startswith(b'ok'):
+            with self.lock:
+                if self.fault_time is not None:
+                    self.recovery.append(millis() - self.fault_time)
+                    self.fault_time = None
+        return line
+
+    def readline(self):
+        if self.duplicates:
+            return self.deliver(self.duplicates.pop())
+        if self.delayed:
+            wait = self.delayed[0][0] - millis()
+            if wait <= 0:
+                return self.deliver(heapq.heappop(self.delayed)[2])
+            # Don't sit in the port timeout while a late line is due
+            timeout, self.port.timeout = self.port.timeout, wait / 1000
+            try:
+                line = self.port.readline()
+            finally:
+                self.port.timeout = timeout
+        else:
+            line = self.port.readline()
+        if not line or not self.enabled:
+            return line
+
+        rnd, profile = self.rx_random, self.profile
+        if self.rx_burst.lost(rnd):
+            self.fault('rx_burst_loss')
+            return b''
+        if rnd.random() < profile.line_drop_rate:
+            self.fault('rx_line_drop')
+            return b''
+        if line.startswith(b'ok'):
+            if rnd.random() < profile.delay_ok_rate:
+                self.sequence += 1
+                heapq.heappush(self.delayed, (millis() + rnd.uniform(*profile.delay_ok), self.sequence, line))
+                self.fault('rx_delay_ok')
+                return b''
+            if rnd.random() < profile.duplicate_ok_rate:
+                self.duplicates.append(line)
+                with self.lock:
+                    self.faults['rx_duplicate_ok'] = self.faults.get('rx_duplicate_ok', 0) + 1
+        data = bytearray(line)
+        if self.flip_bits(rnd, data):
+            self.fault('rx_bit_flip')
+        return self.deliver(bytes(data))
+
+
+class LoopbackPipe(object):
+    """One direction of the in-process link"""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+
+    def write(self, data):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify_all()
+        return len(data)
+
+    def read(self, size, timeout, until = None):
+        # Wait up to timeout for data, return up to size bytes or up to and including 'until'
+        with self.condition:
+            end = time.monotonic() + timeout
+            while True:
+                if until is not None:
+                    index = self.buffer.find(until)
+                    if index >= 0:
+                        size = index + 1
+                        break
+                elif len(self.buffer):
+                    break
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+
+class LoopbackPort(object):
+    """The subset of serial.Serial the protocol uses, on a pair of LoopbackPipes"""
+    def __init__(self, rx, tx, timeout = 1):
+        self.rx = rx
+        self.tx = tx
+        self.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        return len(self.rx.buffer)
+
+    def write(self, data):
+        return self.tx.write(data)
+
+    def read(self, size = 1):
+        return self.rx.read(size, self.timeout)
+
+    def readline(self):
+        line = self.rx.read(len(self.rx.buffer), self.timeout, b'\n')
+        return line
+
+    def reset_input_buffer(self):
+        with self.rx.condition:
+            self.rx.buffer.clear()
+
+    def close(self):
+        pass
+
+class LoopbackClient(object):
+    """Firmware side of the binary protocol (binary_stream.h) with a file transfer
+    endpoint that only counts the bytes written. ASCII lines are answered with 'ok',
+    'M28B1' switches to binary mode and the CONTROL CLOSE packet back."""
+    PACKET_TOKEN = 0xB5AD
+    VERSION = "0.1.0"
+    FILE_TRANSFER_VERSION = "0.2.0"
+
+    def __init__(self, port, buffer_size = 512, packet_max_wait = 100):
+        self.port = port
+        self.buffer_size = buffer_size
+        self.packet_max_wait = packet_max_wait
+        self.binary = False
+        self.line = bytearray()
+        self.sync = 0
+        self.retries = 0
+        self.bytes_written = 0
+        self.packets = 0
+        self.reset_packet()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def reply(self, text):
+        self.port.write(bytes(text + "\n", "utf8"))
+
+    def reset_packet(self):
+        self.state = 'wait'
+        self.token = 0
+        self.header = bytearray()
+        self.payload = bytearray()
+        self.footer = bytearray()
+        self.checksum = 0
+        self.header_checksum = 0
+
+    @staticmethod
+    def fletcher(cs, value):
+        cs_low = ((cs & 0xFF) + value) % 255
+        return ((((cs >> 8) + cs_low) % 255) << 8) | cs_low
+
+    def run(self):
+        last_rx = millis()
+        while self.running:
+            data = self.port.read(4096)
+            if data:
+                last_rx = millis()
+                for b in data:
+                    self.feed(b)
+            elif self.binary and self.state != 'wait' and millis() - last_rx > self.packet_max_wait:
+                self.resend()   # datastream timeout, the rest of the packet got lost
+
+    def feed(self, b):
+        if not self.binary:
+            if b == 10:
+                line = self.line.decode('utf8', 'replace').strip()
+                self.line = bytearray()
+                if line == 'M28B1':
+                    self.binary = True
+                    self.reset_packet()
+                if line:
+                    self.reply("ok")
+            else:
+                self.line.append(b)
+            return
+
+        if self.state == 'wait':
+            self.token = ((self.token << 8) | b) & 0xFFFF
+            if self.token == ((self.PACKET_TOKEN & 0xFF) << 8) | (self.PACKET_TOKEN >> 8):
+                self.state = 'header'
+        elif self.state == 'header':
+            # The payload checksum runs on from the header, header checksum included
+            self.header.append(b)
+            self.checksum = self.fletcher(self.checksum, b)
+            if len(self.header) == 4:
+                self.header_checksum = self.checksum
+            elif len(self.header) == 6:
+                self.header_received()
+        elif self.state == 'data':
+            self.payload.append(b)
+            self.checksum = self.fletcher(self.checksum, b)
+            if len(self.payload) == self.size:
+                self.state = 'footer'
+        elif self.state == 'footer':
+            self.footer.append(b)
+            if len(self.footer) == 2:
+                if self.footer[0] | (self.footer[1] << 8) == self.checksum:
+                    self.process()
+                else:
+                    self.resend()
+
+    def resend(self):
+        self.reset_packet()
+        self.retries += 1
+        self.reply("rs{0}".format(self.sync))
+
+    def header_received(self):
+        sync, kind = self.header[0], self.header[1]
+        self.size = self.header[2] | (self.header[3] << 8)
+        if self.header[4] | (self.header[5] << 8) != self.header_checksum:
+            return self.resend()
+        if kind == 0x01:
+            # SYNC control packet, valid whatever the sync
+            self.reply("ss{0},{1},{2}".format(self.sync, self.buffer_size, self.VERSION))
+            return self.reset_packet()
+        if sync == self.sync:
+            if self.size > self.buffer_size:
+                self.reply("fe{0}".format(sync))
+                self.sync = self.retries = 0
+                return self.reset_packet()
+            if not self.size:
+                return self.process()
+            self.state = 'data'
+        elif sync == (self.sync - 1) % 256:
+            self.reply("ok{0}".format(sync))   # our 'ok' got lost, acknowledge again
+            self.reset_packet()
+        elif self.retries:
+            self.reset_packet()     # packets sent before the resend request, drop them quietly
+        else:
+            self.resend()
+
+    def process(self):
+        kind = self.header[1]
+        payload = self.payload
+        self.reply("ok{0}".format(self.sync))
+        self.sync = (self.sync + 1) % 256
+        self.retries = 0
+        self.packets += 1
+        self.reset_packet()
+
+        protocol, packet_type = kind >> 4, kind & 0xF
+        if protocol == 0 and packet_type == 2:
+            self.binary = False
+        elif protocol == 1:
+            if packet_type == 0:
+                self.reply("PFT:version:{0}:compression:none".format(self.FILE_TRANSFER_VERSION))
+            elif packet_type == 3:
+                self.bytes_written += len(payload)
+            else:
+                self.reply("PFT:success")
+
+
+class SoakProtocol(MarlinBinaryProtocol.Protocol):
+    """Protocol on a port object handed in by the caller"""
+    def __init__(self, port, block_size, timeout):
+        self.soak_port = port
+        super().__init__(getattr(port, 'name', 'loopback'), 0, block_size, 0, timeout)
+
+    def open_port(self):
+        return self.soak_port
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def soak(protocol, port, total_bytes, seed = 0, retries = 10):
+    """Stream total_bytes of dummy WRITE packets with faults enabled only while
+    streaming, the connection setup has no retry logic of its own"""
+    port.enabled = False
+    protocol.connect()
+    filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
+    filetransfer.connect()
+    filetransfer.open("soak.bin", False, True)
+
+    rnd = random.Random(seed)
+    payload = bytes(rnd.randrange(256) for i in range(protocol.block_size))
+    sent = 0
+    dump_pctg = 0
+    ok = True
+    port.enabled = True
+    start_time = millis()
+    try:
+        while sent < total_bytes:
+            block = payload[:min(len(payload), total_bytes - sent)]
+            filetransfer.write_retry(block, retries)
+            sent += len(block)
+            if sent / total_bytes >= dump_pctg:
+                elapsed = max(millis() - start_time, 1)
+                print("\r{0:3.0f}% {1:8.2f}KiB/s Errors: {2}".format(sent / total_bytes * 100, sent / 1024 / elapsed * 1000, protocol.errors), end='')
+                dump_pctg += 0.1
+    except (MarlinBinaryProtocol.ConnectionLost, MarlinBinaryProtocol.FatalError):
+        ok = False
+    elapsed = max(millis() - start_time, 1)
+    port.enabled = False
+    print("")
+    if ok:
+        filetransfer.close()
+        protocol.disconnect()
+    return ok, sent, elapsed
+
+def report(ok, sent, elapsed, protocol, port, client = None):
+    metrics = protocol.metrics
+    print("Result: {0}".format("completed" if ok else "connection lost"))
+    print("Payload: {0:.2f} MiB in {1:.1f}s, goodput {2:.2f} KiB/s".format(sent / 1048576, elapsed / 1000, sent / 1024 / elapsed * 1000))
+    print("Wire bytes: {0}, efficiency {1:.1f}%".format(metrics.bytes_sent, 100.0 * sent / max(metrics.bytes_sent, 1)))
+    print("Faults: {0}".format(", ".join("{0} {1}".format(k, v) for k, v in sorted(port.faults.items())) or "none"))
+    print("Retransmits: {0} (rs {1}, timeouts {2})".format(metrics.retransmits, metrics.resends, metrics.timeouts))
+    print("Recovery latency: p50 {0:.1f}ms, p95 {1:.1f}ms, max {2:.1f}ms ({3} recoveries)".format(
+        percentile(port.recovery, 0.5), percentile(port.recovery, 0.95), max(port.recovery or [0]), len(port.recovery)))
+    if client:
+        # Acknowledged bytes the client never got mean an 'ok' was forged by corruption
+        print("Client received: {0} bytes{1}".format(client.bytes_written, "" if client.bytes_written == sent else " - MISMATCH"))
+
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Soak test the binary file transfer protocol under injected faults")
+    parser.add_argument('--bytes', type=parse_size, default=parse_size('16M'), help='payload to stream, e.g. 512K, 64M, 1G')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='shop')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fault', action='append', default=[], metavar='NAME=VALUE', help='override a FaultProfile rate')
+    parser.add_argument('--port', help='serial port of a real client, default is the in-process loopback')
+    parser.add_argument('--baud', type=int, default=250000)
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--timeout', type=int, default=250, help='response timeout, ms')
+    args = parser.parse_args()
+
+    settings = dict(PROFILES[args.profile])
+    for fault in args.fault:
+        name, _, value = fault.partition('=')
+        settings[name] = float(value)
+    profile = FaultProfile(**settings)
+
+    client = None
+    if args.port:
+        import serial
+        port = FaultyPort(serial.Serial(args.port, baudrate = args.baud, write_timeout = 0, timeout = 1), profile, args.seed)
+    else:
+        to_client, to_host = LoopbackPipe(), LoopbackPipe()
+        client = LoopbackClient(LoopbackPort(to_client, to_host, timeout = 0.01), args.block_size)
+        port = FaultyPort(LoopbackPort(to_host, to_client), profile, args.seed)
+
+    protocol = SoakProtocol(port, args.block_size, args.timeout)
+    try:
+        ok, sent, elapsed = soak(protocol, port, args.bytes, args.seed)
+        report(ok, sent, elapsed, protocol, port, client)
+    finally:
+        protocol.shutdown()
+        if client:
+            client.stop()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#
+# build_envs.py
+# Build several PlatformIO environments at once, then report how long each
+# env and each phase of the Marlin build scripts took.
+#
+#   python buildroot/share/scripts/build_envs.py -j 3 mega2560 LPC1768 STM32F103RE_btt
+#
+# Each env is a separate 'platformio run', so its output goes to a log file
+# instead of the console. The make jobs of the envs are split so the builds
+# together use about one job per CPU.
+#
+# The preprocessor output used by common-dependencies.py and signature.py is
+# cached in the project build folder by command line, so envs with the same
+# compiler and flags preprocess the configuration only once between them.
+#
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class EnvBuild(object):
+    def __init__(self, name, log_path):
+        self.name = name
+        self.log_path = log_path
+        self.result = None
+        self.seconds = 0.0
+
+def run_env(build, args, jobs, timings_path):
+    cmd = ['platformio', 'run', '-e', build.name, '--jobs', str(jobs)]
+    for target in args.target:
+        cmd += ['--target', target]
+    if args.project_dir:
+        cmd += ['--project-dir', args.project_dir]
+
+    proc_env = dict(os.environ, MARLIN_BUILD_TIMINGS=timings_path)
+    start = time.time()
+    with open(build.log_path, 'w') as log:
+        log.write(' '.join(cmd) + '\n')
+        log.flush()
+        try:
+            build.result = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=proc_env)
+        except OSError as e:
+            log.write(str(e) + '\n')
+            build.result = -1
+    build.seconds = time.time() - start
+    return build
+
+def load_timings(path):
+    records = []
+    try:
+        with open(path) as infile:
+            for line in infile:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except OSError:
+        pass
+    return records
+
+def report(builds, records, wall):
+    print("\n%-30s %8s  %s" % ("env", "seconds", "result"))
+    for build in builds:
+        print("%-30s %8.1f  %s" % (build.name, build.seconds, "ok" if build.result == 0 else "FAILED (%s)" % build.log_path))
+
+    # Time spent in each phase summed over the envs. 'features' includes the
+    # first 'preprocess' of the env, 'signature' reuses its output.
+    phases = {}
+    for record in records:
+        phase = phases.setdefault(record['phase'], { 'count': 0, 'seconds': 0.0, 'max': 0.0, 'hit': 0, 'miss': 0 })
+        phase['count'] += 1
+        phase['seconds'] += record['seconds']
+        phase['max'] = max(phase['max'], record['seconds'])
+        if record.get('cache') in ('hit', 'miss'):
+            phase[record['cache']] += 1
+
+    if phases:
+        print("\n%-16s %5s %9s %8s %8s  %s" % ("phase", "runs", "total s", "mean s", "max s", "cache hit/miss"))
+        for name, phase in sorted(phases.items(), key=lambda item: -item[1]['seconds']):
+            cache = "%d/%d" % (phase['hit'], phase['miss']) if phase['hit'] or phase['miss'] else ""
+            print("%-16s %5d %9.2f %8.2f %8.2f  %s" % (name, phase['count'], phase['seconds'],
+                                                       phase['seconds'] / phase['count'], phase['max'], cache))
+
+    serial = sum(build.seconds for build in builds)
+    print("\nWall time %.1f s for %.1f s of builds (%.1fx)" % (wall, serial, serial / max(wall, 1e-6)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Build PlatformIO environments in parallel")
+    parser.add_argument('envs', nargs='+', help='PlatformIO environments to build')
+    parser.add_argument('-j', '--parallel', type=int, default=2, help='envs built at the same time')
+    parser.add_argument('-t', '--target', action='append', default=[], help='PlatformIO target, as for platformio run')
+    parser.add_argument('-d', '--project-dir', default=None, help='Marlin project folder')
+    parser.add_argument('--log-dir', default=None, help='log folder, default .pio/build_envs')
+    args = parser.parse_args()
+
+    parallel = max(1, min(args.parallel, len(args.envs)))
+    jobs = max(1, (os.cpu_count() or 1) // parallel)
+
+    log_dir = args.log_dir or os.path.join(args.project_dir or '.', '.pio', 'build_envs')
+    os.makedirs(log_dir, exist_ok=True)
+    timings_path = os.path.join(log_dir, 'timings.jsonl')
+    if os.path.exists(timings_path):
+        os.remove(timings_path)
+
+    builds = [ EnvBuild(name, os.path.join(log_dir, name + '.log')) for name in args.envs ]
+    print_lock = threading.Lock()
+
+    def build_one(build):
+        with print_lock:
+            print("Building %s" % build.name)
+        run_env(build, args, jobs, timings_path)
+        with print_lock:
+            print("%s %s in %.1f s" % (build.name, "done" if build.result == 0 else "FAILED", build.seconds))
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        list(executor.map(build_one, builds))
+
+    report(builds, load_timings(timings_path), time.time() - start)
+    return 0 if all(build.result == 0 for build in builds) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#
+# gcode_compact.py
+# Shrink a G-code job before it is sent to the client. Comments and redundant
+# modal words are dropped and numbers are written with the fewest characters,
+# so what the client executes is unchanged but fewer bytes cross the link and
+# the heatshrink stage that follows has less to chew on.
+#
+#   python gcode_compact.py job.gcode job.min.gcode
+#
+import argparse
+import decimal
+import re
+
+# Quantum of the laser firmware (GcodeParser.pulse), in mm
+DEFAULT_RESOLUTION = 0.02
+
+# Words a motion line may carry besides its G0 / G1
+MOTION_WORDS = 'XYZEFS'
+QUANTIZED_AXES = 'XY'
+
+WORD_RE = re.compile(r'([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))')
+
+def format_number(text):
+    # Shortest spelling of a decimal literal: '+010.500' -> '10.5', '-0.50' -> '-.5', '-0.0' -> '0'
+    sign = '-' if text.startswith('-') else ''
+    whole, _, fraction = text.lstrip('+-').partition('.')
+    whole = whole.lstrip('0')
+    fraction = fraction.rstrip('0')
+    if not whole and not fraction:
+        return '0'
+    return sign + whole + ('.' + fraction if fraction else '')
+
+class GcodeCompactor(object):
+    """Rewrite G-code line by line into an equivalent, shorter form.
+    Only G0 / G1 lines made of X Y Z E F S words are rewritten, any other line is
+    passed through with its comment and surrounding blanks removed.
+
+    X / Y are rounded to 'resolution' (None keeps them exact). In relative mode
+    (G91) the rounding error is carried into the next move the way
+    GcodeParser._adjust_coordinates does, so positions never drift.
+    F is dropped when unchanged. S is dropped when unchanged since the last G1,
+    as a G0 turns the laser off for GcodeParser. The G0 / G1 word itself is only
+    dropped with modal_motion, for firmware built with GCODE_MOTION_MODES."""
+    def __init__(self, resolution = DEFAULT_RESOLUTION, modal_motion = False):
+        self.resolution = resolution or None
+        if self.resolution:
+            self.decimals = max(-decimal.Decimal(str(self.resolution)).as_tuple().exponent, 0)
+        self.modal_motion = modal_motion
+        self.relative = False
+        self.motion = None      # current motion mode, None when unknown
+        self.feedrate = None    # last F / S words as written, None when unknown
+        self.power = None
+        self.remaining = dict.fromkeys(QUANTIZED_AXES, 0.0)
+
+    def quantize(self, axis, text):
+        value = float(text)
+        if self.relative:
+            value += self.remaining[axis]
+        steps = round(value / self.resolution)
+        if self.relative:
+            self.remaining[axis] = value - steps * self.resolution
+        return format_number('{0:.{1}f}'.format(steps * self.resolution, self.decimals))
+
+    def passthrough(self, line):
+        # Keep the line as is, but forget any modal state it may change
+        words = WORD_RE.findall(line.upper())
+        if words and words[0][0] == 'G':
+            code = format_number(words[0][1])
+            if code == '90':
+                self.relative = False
+            elif code == '91':
+                self.relative = True
+            elif code not in ('4', '92'):
+                self.motion = None
+            if code == '0':
+                self.power = None
+        letters = set(letter for letter, _ in words)
+        if 'F' in letters:
+            self.feedrate = None
+        if 'S' in letters or words and words[0][0] == 'M':
+            self.power = None
+        return line
+
+    def compact_line(self, line):
+        """Return the compacted line without EOL, or None when nothing is left"""
+        line = line.split(';', 1)[0].strip()
+        if not line:
+            return None
+        text = line.upper().replace(' ', '')
+        words = WORD_RE.findall(text)
+        if (not words or words[0][0] != 'G' or format_number(words[0][1]) not in ('0', '1')
+                or ''.join(letter + value for letter, value in words) != text
+                or any(letter not in MOTION_WORDS for letter, _ in words[1:])):
+            return self.passthrough(line)
+
+        motion = format_number(words[0][1])
+        out = []
+        for letter, value in words[1:]:
+            if letter in QUANTIZED_AXES and self.resolution:
+                value = self.quantize(letter, value)
+            else:
+                value = format_number(value)
+            if letter == 'F':
+                if value == self.feedrate:
+                    continue
+                # GcodeParser ignores F on G0, firmware without G0_FEEDRATE keeps it
+                self.feedrate = value if motion == '1' else None
+            elif letter == 'S':
+                if motion == '1' and value == self.power:
+                    continue
+                self.power = value if motion == '1' else None
+            elif self.relative and value == '0':
+                continue
+            out.append(letter + value)
+        if motion == '0':
+            self.power = None
+
+        if not out:
+            # A relative move of nothing, or an absolute G0 / G1 with no words
+            if self.relative or len(words) > 1:
+                return None
+            return 'G' + motion
+        # The firmware only applies the motion mode to lines starting with an axis or F
+        modal = self.modal_motion and motion == self.motion and out[0][0] != 'S'
+        prefix = '' if modal else 'G' + motion
+        self.motion = motion
+        return prefix + ''.join(out)
+
+    def compact(self, lines):
+        for line in lines:
+            line = self.compact_line(line)
+            if line is not None:
+                yield line
+
+def compact_file(filename, dest_filename, **kwargs):
+    """Write the compacted copy of filename, return the (source, compacted) sizes"""
+    compactor = GcodeCompactor(**kwargs)
+    size_in = size_out = 0
+    with open(filename, 'r', errors='surrogateescape', newline='') as infile, \
+         open(dest_filename, 'w', errors='surrogateescape', newline='\n') as outfile:
+        for line in infile:
+            size_in += len(line)
+            line = compactor.compact_line(line)
+            if line is not None:
+                outfile.write(line + '\n')
+                size_out += len(line) + 1
+    return size_in, size_out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compact a G-code file before upload")
+    parser.add_argument('filename')
+    parser.add_argument('dest_filename')
+    parser.add_argument('-r', '--resolution', type=float, default=DEFAULT_RESOLUTION, help='X/Y resolution in mm, 0 to keep exact values')
+    parser.add_argument('-m', '--modal-motion', action='store_true', help='drop repeated G0/G1 (firmware with GCODE_MOTION_MODES)')
+    args = parser.parse_args()
+
+    size_in, size_out = compact_file(args.filename, args.dest_filename, resolution=args.resolution, modal_motion=args.modal_motion)
+    print("{0} -> {1} bytes ({2:4.1f}%)".format(size_in, size_out, 100.0 * size_out / max(size_in, 1)))
@@ -0,0 +1,146 @@
+#
+# heatshrink_encoder.py
+# Pure Python heatshrink encoder, used by MarlinBinaryProtocol when the
+# 'heatshrink' module is not installed. The output decodes with the firmware
+# decoder for the window / lookahead sizes it reports in 'PFT:version'.
+#
+# Run it on a G-code file to compare window / lookahead sizes for the firmware
+# (HEATSHRINK_STATIC_WINDOW_BITS / HEATSHRINK_STATIC_LOOKAHEAD_BITS):
+#   python heatshrink_encoder.py job.gcode
+#
+import argparse
+import time
+
+class Encoder(object):
+    """Incremental encoder: fill() returns the bytes that are ready, finish() the rest.
+    Matches are found through hash chains over byte pairs, limited to chain_depth
+    candidates per position to keep the cost per byte bounded."""
+    def __init__(self, window_sz2 = 8, lookahead_sz2 = 4, chain_depth = 16):
+        if not (4 <= window_sz2 <= 15 and 3 <= lookahead_sz2 < window_sz2):
+            raise ValueError("Invalid window / lookahead size")
+        self.window_sz2 = window_sz2
+        self.lookahead_sz2 = lookahead_sz2
+        self.window = 1 << window_sz2
+        self.max_len = 1 << lookahead_sz2
+        # A back reference only pays off when it is shorter than the literals it replaces
+        self.min_len = (1 + window_sz2 + lookahead_sz2) // 8 + 1
+        self.chain_depth = chain_depth
+
+        self.data = bytearray()     # input, from absolute position self.base on
+        self.base = 0
+        self.pos = 0                # next absolute position to encode
+        self.head = {}              # byte pair -> last absolute position
+        self.prev = []              # absolute position - base -> previous position with the same pair
+
+        self.out = bytearray()
+        self.bits = 0
+        self.bit_count = 0
+
+    def put_bits(self, value, count):
+        self.bits = (self.bits << count) | value
+        self.bit_count += count
+        while self.bit_count >= 8:
+            self.bit_count -= 8
+            self.out.append((self.bits >> self.bit_count) & 0xFF)
+        self.bits &= (1 << self.bit_count) - 1
+
+    def insert(self, pos, end):
+        if pos + 1 < end:
+            i = pos - self.base
+            key = (self.data[i] << 8) | self.data[i + 1]
+            self.prev.append(self.head.get(key, -1))
+            self.head[key] = pos
+        else:
+            self.prev.append(-1)
+
+    def longest_match(self, pos, end):
+        data, base = self.data, self.base
+        i = pos - base
+        avail = min(self.max_len, end - pos)
+        if avail < self.min_len:
+            return 0, 0
+        best_len, best_offset = 0, 0
+        limit = max(base, pos - self.window)
+        cand = self.head.get((data[i] << 8) | data[i + 1], -1)
+        depth = self.chain_depth
+        while cand >= limit and depth:
+            j = cand - base
+            if data[j + best_len] == data[i + best_len] if best_len < avail else True:
+                length = 2
+                while length < avail and data[j + length] == data[i + length]:
+                    length += 1
+                if length > best_len:
+                    best_len, best_offset = length, pos - cand
+                    if length == avail:
+                        break
+            cand = self.prev[j]
+            depth -= 1
+        return best_len, best_offset
+
+    def encode(self, end):
+        # Encode up to the absolute position end, the input beyond is known to exist only at finish()
+        pos = self.pos
+        while pos < end:
+            length, offset = self.longest_match(pos, self.base + len(self.data))
+            self.insert(pos, self.base + len(self.data))
+            if length >= self.min_len:
+                self.put_bits(0, 1)
+                self.put_bits(offset - 1, self.window_sz2)
+                self.put_bits(length - 1, self.lookahead_sz2)
+                for p in range(pos + 1, pos + length):
+                    self.insert(p, self.base + len(self.data))
+                pos += length
+            else:
+                self.put_bits(0x100 | self.data[pos - self.base], 9)
+                pos += 1
+        self.pos = pos
+
+        # Keep only the window the next matches can reach
+        drop = self.pos - self.window - self.base
+        if drop > self.window:
+            del self.data[:drop]
+            del self.prev[:drop]
+            self.base += drop
+
+    def take(self):
+        out, self.out = bytes(self.out), bytearray()
+        return out
+
+    def fill(self, data):
+        self.data += data
+        # Hold back a full lookahead so matches are not cut short at the chunk end
+        self.encode(self.base + len(self.data) - self.max_len)
+        return self.take()
+
+    def finish(self):
+        self.encode(self.base + len(self.data))
+        if self.bit_count:
+            self.put_bits(0, 8 - self.bit_count)
+        return self.take()
+
+def encode(buf, window_sz2 = 8, lookahead_sz2 = 4, chain_depth = 16):
+    encoder = Encoder(window_sz2, lookahead_sz2, chain_depth)
+    return encoder.fill(buf) + encoder.finish()
+
+def evaluate(data, candidates):
+    # Compression ratio and encoder speed for each (window, lookahead) pair
+    results = []
+    for window_sz2, lookahead_sz2 in candidates:
+        start_time = time.perf_counter()
+        size = len(encode(data, window_sz2, lookahead_sz2))
+        elapsed = max(time.perf_counter() - start_time, 1e-6)
+        results.append((window_sz2, lookahead_sz2, len(data) / max(size, 1), len(data) / elapsed))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare heatshrink window / lookahead sizes on a file")
+    parser.add_argument('filename')
+    parser.add_argument('-w', '--window', type=int, nargs='*', default=[8, 9, 10, 11, 12], help='window sizes (bits)')
+    parser.add_argument('-l', '--lookahead', type=int, nargs='*', default=[4, 5, 6], help='lookahead sizes (bits)')
+    args = parser.parse_args()
+
+    data = open(args.filename, "rb").read()
+    candidates = [(w, l) for w in args.window for l in args.lookahead if l < w]
+    print("window lookahead  ratio   KiB/s  decoder RAM")
+    for window_sz2, lookahead_sz2, ratio, rate in sorted(evaluate(data, candidates), key=lambda r: -r[2] * r[3]):
+        print("{0:6} {1:9} {2:6.2f} {3:7.1f} {4:8} B".format(window_sz2, lookahead_sz2, ratio, rate / 1024, 1 << window_sz2))
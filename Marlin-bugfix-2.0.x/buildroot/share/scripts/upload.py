@@ -7,7 +7,9 @@ import serial
 
 Import("env")
 
-# Needed (only) for compression, but there are problems with pip install heatshrink
+# Compression uses the 'heatshrink' module when it is installed, or the bundled
+# pure Python encoder (heatshrink_encoder.py) otherwise.
+# There are problems with pip install heatshrink:
 #try:
 #    import heatshrink
 #except ImportError:
@@ -20,6 +22,12 @@ Import("env")
 
 import MarlinBinaryProtocol
 
+try:
+    from signature import get_file_sha256sum
+except ImportError:
+    sys.path.append(env.subst('$PROJECT_DIR/buildroot/share/PlatformIO/scripts'))
+    from signature import get_file_sha256sum
+
 #-----------------#
 # Upload Callback #
 #-----------------#
@@ -51,109 +59,27 @@ def Upload(source, target, env):
         debugPrint('OK')
         return portName
 
-    #-------------------------#
-    # Simple serial functions #
-    #-------------------------#
-    def _OpenPort():
-        # Open serial port
-        if port.is_open: return
-        debugPrint('Opening upload port...')
-        port.open()
-        port.reset_input_buffer()
-        debugPrint('OK')
-
-    def _ClosePort():
-        # Open serial port
-        if port is None: return
-        if not port.is_open: return
-        debugPrint('Closing upload port...')
-        port.close()
-        debugPrint('OK')
-
-    def _Send(data):
-        debugPrint(f'>> {data}')
-        strdata = bytearray(data, 'utf8') + b'\n'
-        port.write(strdata)
-        time.sleep(0.010)
-
-    def _Recv():
-        clean_responses = []
-        responses = port.readlines()
-        for Resp in responses:
-            # Suppress invalid chars (coming from debug info)
-            try:
-                clean_response = Resp.decode('utf8').rstrip().lstrip()
-                clean_responses.append(clean_response)
-                debugPrint(f'<< {clean_response}')
-            except:
-                pass
-        return clean_responses
-
-    #------------------#
-    # SDCard functions #
-    #------------------#
-    def _CheckSDCard():
-        debugPrint('Checking SD card...')
-        _Send('M21')
-        Responses = _Recv()
-        if len(Responses) < 1 or not any('SD card ok' in r for r in Responses):
-            raise Exception('Error accessing SD card')
-        debugPrint('SD Card OK')
-        return True
-
-    #----------------#
-    # File functions #
-    #----------------#
-    def _GetFirmwareFiles(UseLongFilenames):
-        debugPrint('Get firmware files...')
-        _Send(f"M20 F{'L' if UseLongFilenames else ''}")
-        Responses = _Recv()
-        if len(Responses) < 3 or not any('file list' in r for r in Responses):
-            raise Exception('Error getting firmware files')
-        debugPrint('OK')
-        return Responses
-
-    def _FilterFirmwareFiles(FirmwareList, UseLongFilenames):
-        Firmwares = []
-        for FWFile in FirmwareList:
-            # For long filenames take the 3rd column of the firmwares list
-            if UseLongFilenames:
-                Space = 0
-                Space = FWFile.find(' ')
-                if Space >= 0: Space = FWFile.find(' ', Space + 1)
-                if Space >= 0: FWFile = FWFile[Space + 1:]
-            if not '/' in FWFile and '.BIN' in FWFile.upper():
-                Firmwares.append(FWFile[:FWFile.upper().index('.BIN') + 4])
-        return Firmwares
-
-    def _RemoveFirmwareFile(FirmwareFile):
-        _Send(f'M30 /{FirmwareFile}')
-        Responses = _Recv()
-        Removed = len(Responses) >= 1 and any('File deleted' in r for r in Responses)
-        if not Removed:
-            raise Exception(f"Firmware file '{FirmwareFile}' not removed")
-        return Removed
-
-    def _RollbackUpload(FirmwareFile):
-        if not rollback: return
-        print(f"Rollback: trying to delete firmware '{FirmwareFile}'...")
-        _OpenPort()
-        # Wait for SD card release
-        time.sleep(1)
-        # Remount SD card
-        _CheckSDCard()
-        print(' OK' if _RemoveFirmwareFile(FirmwareFile) else ' Error!')
-        _ClosePort()
-
+    def _GetUploadPorts(env):
+        # A list of ports in 'custom_upload_ports' updates several identical devices at once
+        try:
+            ports = env.GetProjectOption('custom_upload_ports')
+        except:
+            ports = None
+        if ports:
+            return [p.strip() for p in ports.replace('\n', ',').split(',') if p.strip()]
+        return [_GetUploadPort(env)]
+
+    def _GetMetricsPath(env):
+        # 'custom_upload_metrics' names a file for the link metrics of each upload:
+        # Prometheus text for '.prom' files, JSON lines otherwise. '{device}' is replaced by the port
+        try:
+            return env.GetProjectOption('custom_upload_metrics') or None
+        except:
+            return None
 
     #---------------------#
     # Callback Entrypoint #
     #---------------------#
-    port = None
-    protocol = None
-    filetransfer = None
-    rollback = False
-
     # Get Marlin evironment vars
     MarlinEnv = env['MARLIN_FEATURES']
     marlin_pioenv = _GetMarlinEnv(MarlinEnv, 'PIOENV')
@@ -171,7 +97,7 @@ def Upload(source, target, env):
     upload_firmware_source_name = str(source[0])    # Source firmware filename
     upload_speed = env['UPLOAD_SPEED'] if 'UPLOAD_SPEED' in env else 115200
                                                     # baud rate of serial connection
-    upload_port = _GetUploadPort(env)               # Serial port to use
+    upload_ports = _GetUploadPorts(env)             # Serial ports to use
 
     # Set local upload params
     upload_firmware_target_name = os.path.basename(upload_firmware_source_name)
@@ -179,9 +105,16 @@ def Upload(source, target, env):
     upload_timeout = 1000                           # Communication timout, lossy/slow connections need higher values
     upload_blocksize = 512                          # Transfer block size. 512 = Autodetect
     upload_compression = True                       # Enable compression
+    upload_adaptive = True                          # Probe the link, tune the block size and compression, retry on errors
+    upload_resume = False                           # Keep a broken upload on the SD card and continue it on the next run
     upload_error_ratio = 0                          # Simulated corruption ratio
     upload_test = False                             # Benchmark the serial link without storing the file
     upload_reset = True                             # Trigger a soft reset for firmware update after the upload
+    upload_retries = 2                              # Upload attempts per device when updating several devices
+    upload_dedup = True                             # Skip the transfer if the device already holds this exact file
+    upload_rx_buffer_size = MarlinBinaryProtocol.rx_buffer_size(MarlinEnv)
+                                                    # Client RX buffer, limits batched commands
+    upload_metrics = _GetMetricsPath(env)           # Link metrics export, see _GetMetricsPath
 
     # Set local upload params based on board type to change script behavior
     # "upload_delete_old_bins": delete all *.bin files in the root of SD Card
@@ -190,153 +123,367 @@ def Upload(source, target, env):
                                                     'BOARD_CREALITY_V24S1']
     # "upload_random_name": generate a random 8.3 firmware filename to upload
     upload_random_filename = upload_delete_old_bins and not marlin_long_filename_host_support
-
-    try:
-
-        # Start upload job
-        print(f"Uploading firmware '{os.path.basename(upload_firmware_target_name)}' to '{marlin_motherboard}' via '{upload_port}'")
-
-        # Dump some debug info
-        if Debug:
-            print('Upload using:')
-            print('---- Marlin -----------------------------------')
-            print(f' PIOENV                      : {marlin_pioenv}')
-            print(f' SHORT_BUILD_VERSION         : {marlin_short_build_version}')
-            print(f' STRING_CONFIG_H_AUTHOR      : {marlin_string_config_h_author}')
-            print(f' MOTHERBOARD                 : {marlin_motherboard}')
-            print(f' BOARD_INFO_NAME             : {marlin_board_info_name}')
-            print(f' CUSTOM_BUILD_FLAGS          : {marlin_board_custom_build_flags}')
-            print(f' FIRMWARE_BIN                : {marlin_firmware_bin}')
-            print(f' LONG_FILENAME_HOST_SUPPORT  : {marlin_long_filename_host_support}')
-            print(f' LONG_FILENAME_WRITE_SUPPORT : {marlin_longname_write}')
-            print(f' CUSTOM_FIRMWARE_UPLOAD      : {marlin_custom_firmware_upload}')
-            print('---- Upload parameters ------------------------')
-            print(f' Source                      : {upload_firmware_source_name}')
-            print(f' Target                      : {upload_firmware_target_name}')
-            print(f' Port                        : {upload_port} @ {upload_speed} baudrate')
-            print(f' Timeout                     : {upload_timeout}')
-            print(f' Block size                  : {upload_blocksize}')
-            print(f' Compression                 : {upload_compression}')
-            print(f' Error ratio                 : {upload_error_ratio}')
-            print(f' Test                        : {upload_test}')
-            print(f' Reset                       : {upload_reset}')
-            print('-----------------------------------------------')
-
-        # Custom implementations based on board parameters
-        # Generate a new 8.3 random filename
-        if upload_random_filename:
-            upload_firmware_target_name = f"fw-{''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=5))}.BIN"
-            print(f"Board {marlin_motherboard}: Overriding firmware filename to '{upload_firmware_target_name}'")
-
-        # Delete all *.bin files on the root of SD Card (if flagged)
-        if upload_delete_old_bins:
-            # CUSTOM_FIRMWARE_UPLOAD is needed for this feature
-            if not marlin_custom_firmware_upload:
-                raise Exception(f"CUSTOM_FIRMWARE_UPLOAD must be enabled in 'Configuration_adv.h' for '{marlin_motherboard}'")
-
-            # Init & Open serial port
-            port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
+    # Old firmware files are deleted or renamed on these boards, nothing to deduplicate
+    upload_dedup = upload_dedup and not upload_delete_old_bins and not upload_test
+
+    # Content-addressed record of what each device already holds
+    if upload_dedup:
+        upload_cache = MarlinBinaryProtocol.UploadCache(os.path.join(env.subst('$PROJECT_BUILD_DIR'), 'upload_cache.json'))
+        upload_firmware_sha256 = get_file_sha256sum(upload_firmware_source_name)
+
+    #---------------#
+    # Device upload #
+    #---------------#
+    def _UploadDevice(upload_port, upload_firmware_target_name):
+
+        port = None
+        protocol = None
+        filetransfer = None
+        rollback = False
+
+        #-------------------------#
+        # Simple serial functions #
+        #-------------------------#
+        def _OpenPort():
+            # Open serial port
+            if port.is_open: return
+            debugPrint('Opening upload port...')
+            port.open()
+            port.reset_input_buffer()
+            debugPrint('OK')
+
+        def _ClosePort():
+            # Open serial port
+            if port is None: return
+            if not port.is_open: return
+            debugPrint('Closing upload port...')
+            port.close()
+            debugPrint('OK')
+
+        def _Send(data):
+            debugPrint(f'>> {data}')
+            strdata = bytearray(data, 'utf8') + b'\n'
+            port.write(strdata)
+
+        def _Recv(Count = 1, Timeout = 2.0):
+            # Read until 'Count' commands are acknowledged with 'ok' instead of waiting out the port timeout
+            clean_responses = []
+            deadline = time.time() + Timeout
+            while Count > 0 and time.time() < deadline:
+                Resp = port.readline()
+                if not Resp: continue
+                # Suppress invalid chars (coming from debug info)
+                try:
+                    clean_response = Resp.decode('utf8').rstrip().lstrip()
+                    clean_responses.append(clean_response)
+                    debugPrint(f'<< {clean_response}')
+                except:
+                    continue
+                if clean_response.startswith('ok'): Count -= 1
+            return clean_responses
+
+        def _SendBatch(Commands):
+            # Queue as many commands as the client RX buffer holds, then collect their responses
+            Responses = []
+            Batch, BatchSize = [], 0
+            for Command in Commands + [None]:
+                Length = len(Command) + 1 if Command else 0
+                if Batch and (Command is None or BatchSize + Length > upload_rx_buffer_size):
+                    for Queued in Batch: _Send(Queued)
+                    Responses += _Recv(len(Batch))
+                    Batch, BatchSize = [], 0
+                if Command:
+                    Batch.append(Command)
+                    BatchSize += Length
+            return Responses
+
+        #------------------#
+        # SDCard functions #
+        #------------------#
+        def _CheckSDCard():
+            debugPrint('Checking SD card...')
+            _Send('M21')
+            Responses = _Recv()
+            if len(Responses) < 1 or not any('SD card ok' in r for r in Responses):
+                raise Exception('Error accessing SD card')
+            debugPrint('SD Card OK')
+            return True
+
+        def _WaitSDCard(Timeout = 2.0):
+            # Remount as soon as the SD card is released instead of sleeping a fixed time
+            deadline = time.time() + Timeout
+            while True:
+                try:
+                    return _CheckSDCard()
+                except Exception:
+                    if time.time() >= deadline: raise
+                    time.sleep(0.05)
+
+        #----------------#
+        # File functions #
+        #----------------#
+        def _GetFirmwareFiles(UseLongFilenames):
+            debugPrint('Get firmware files...')
+            _Send(f"M20 F{'L' if UseLongFilenames else ''}")
+            Responses = _Recv()
+            if len(Responses) < 3 or not any('file list' in r for r in Responses):
+                raise Exception('Error getting firmware files')
+            debugPrint('OK')
+            return Responses
+
+        def _FilterFirmwareFiles(FirmwareList, UseLongFilenames):
+            Firmwares = []
+            for FWFile in FirmwareList:
+                # For long filenames take the 3rd column of the firmwares list
+                if UseLongFilenames:
+                    Space = 0
+                    Space = FWFile.find(' ')
+                    if Space >= 0: Space = FWFile.find(' ', Space + 1)
+                    if Space >= 0: FWFile = FWFile[Space + 1:]
+                if not '/' in FWFile and '.BIN' in FWFile.upper():
+                    Firmwares.append(FWFile[:FWFile.upper().index('.BIN') + 4])
+            return Firmwares
+
+        def _RemoveFirmwareFile(FirmwareFile):
+            _Send(f'M30 /{FirmwareFile}')
+            Responses = _Recv()
+            Removed = len(Responses) >= 1 and any('File deleted' in r for r in Responses)
+            if not Removed:
+                raise Exception(f"Firmware file '{FirmwareFile}' not removed")
+            return Removed
+
+        def _RemoveFirmwareFiles(FirmwareFiles):
+            Responses = _SendBatch([f'M30 /{FirmwareFile}' for FirmwareFile in FirmwareFiles])
+            Deleted = [r[len('File deleted:'):].upper() for r in Responses if r.startswith('File deleted:')]
+            NotRemoved = [f for f in FirmwareFiles if f.upper() not in Deleted]
+            if NotRemoved:
+                raise Exception(f"Firmware file{'s' if len(NotRemoved) != 1 else ''} {', '.join(NotRemoved)} not removed")
+            return True
+
+        def _RollbackUpload(FirmwareFile):
+            if not rollback: return
+            # A resumable upload keeps the partial file for the next run
+            if upload_resume: return
+            print(f"Rollback: trying to delete firmware '{FirmwareFile}'...")
             _OpenPort()
+            # Remount SD card once it is released
+            _WaitSDCard()
+            print(' OK' if _RemoveFirmwareFile(FirmwareFile) else ' Error!')
+            _ClosePort()
 
-            # Check SD card status
-            _CheckSDCard()
 
-            # Get firmware files
-            FirmwareFiles = _GetFirmwareFiles(marlin_long_filename_host_support)
-            if Debug:
-                for FirmwareFile in FirmwareFiles:
-                    print(f'Found: {FirmwareFile}')
 
-            # Get all 1st level firmware files (to remove)
-            OldFirmwareFiles = _FilterFirmwareFiles(FirmwareFiles[1:len(FirmwareFiles)-2], marlin_long_filename_host_support)   # Skip header and footers of list
-            if len(OldFirmwareFiles) == 0:
-                print('No old firmware files to delete')
+        try:
+
+            # Start upload job
+            print(f"Uploading firmware '{os.path.basename(upload_firmware_target_name)}' to '{marlin_motherboard}' via '{upload_port}'")
+
+            # Dump some debug info
+            if Debug:
+                print('Upload using:')
+                print('---- Marlin -----------------------------------')
+                print(f' PIOENV                      : {marlin_pioenv}')
+                print(f' SHORT_BUILD_VERSION         : {marlin_short_build_version}')
+                print(f' STRING_CONFIG_H_AUTHOR      : {marlin_string_config_h_author}')
+                print(f' MOTHERBOARD                 : {marlin_motherboard}')
+                print(f' BOARD_INFO_NAME             : {marlin_board_info_name}')
+                print(f' CUSTOM_BUILD_FLAGS          : {marlin_board_custom_build_flags}')
+                print(f' FIRMWARE_BIN                : {marlin_firmware_bin}')
+                print(f' LONG_FILENAME_HOST_SUPPORT  : {marlin_long_filename_host_support}')
+                print(f' LONG_FILENAME_WRITE_SUPPORT : {marlin_longname_write}')
+                print(f' CUSTOM_FIRMWARE_UPLOAD      : {marlin_custom_firmware_upload}')
+                print('---- Upload parameters ------------------------')
+                print(f' Source                      : {upload_firmware_source_name}')
+                print(f' Target                      : {upload_firmware_target_name}')
+                print(f' Port                        : {upload_port} @ {upload_speed} baudrate')
+                print(f' Timeout                     : {upload_timeout}')
+                print(f' Block size                  : {upload_blocksize}')
+                print(f' Compression                 : {upload_compression}')
+                print(f' Adaptive                    : {upload_adaptive}')
+                print(f' Resume                      : {upload_resume}')
+                print(f' Deduplicate                 : {upload_dedup}')
+                print(f' Error ratio                 : {upload_error_ratio}')
+                print(f' Test                        : {upload_test}')
+                print(f' Reset                       : {upload_reset}')
+                print('-----------------------------------------------')
+
+            # Custom implementations based on board parameters
+            # Generate a new 8.3 random filename
+            if upload_random_filename:
+                upload_firmware_target_name = f"fw-{''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=5))}.BIN"
+                print(f"Board {marlin_motherboard}: Overriding firmware filename to '{upload_firmware_target_name}'")
+
+            # Delete all *.bin files on the root of SD Card (if flagged)
+            if upload_delete_old_bins:
+                # CUSTOM_FIRMWARE_UPLOAD is needed for this feature
+                if not marlin_custom_firmware_upload:
+                    raise Exception(f"CUSTOM_FIRMWARE_UPLOAD must be enabled in 'Configuration_adv.h' for '{marlin_motherboard}'")
+
+                # Init & Open serial port
+                port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
+                _OpenPort()
+
+                # Check SD card status
+                _CheckSDCard()
+
+                # Get firmware files
+                FirmwareFiles = _GetFirmwareFiles(marlin_long_filename_host_support)
+                if Debug:
+                    for FirmwareFile in FirmwareFiles:
+                        print(f'Found: {FirmwareFile}')
+
+                # Get all 1st level firmware files (to remove)
+                OldFirmwareFiles = _FilterFirmwareFiles(FirmwareFiles[1:len(FirmwareFiles)-2], marlin_long_filename_host_support)   # Skip header and footers of list
+                if len(OldFirmwareFiles) == 0:
+                    print('No old firmware files to delete')
+                else:
+                    print(f"Remove {len(OldFirmwareFiles)} old firmware file{'s' if len(OldFirmwareFiles) != 1 else ''}:")
+                    for OldFirmwareFile in OldFirmwareFiles:
+                        print(f" -Removing- '{OldFirmwareFile}'...")
+                    print(' OK' if _RemoveFirmwareFiles(OldFirmwareFiles) else ' Error!')
+
+                # Close serial
+                _ClosePort()
+
+                # Cleanup completed
+                debugPrint('Cleanup completed')
+
+            # WARNING! The serial port must be closed here because the serial transfer that follow needs it!
+
+            # Skip the transfer if the SD card already holds this exact file
+            upload_skip = False
+            if upload_dedup:
+                try:
+                    port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
+                    _OpenPort()
+                    _CheckSDCard()
+                    FirmwareFiles = _GetFirmwareFiles(marlin_long_filename_host_support)
+                    upload_skip = upload_cache.is_current(upload_port, upload_firmware_target_name, upload_firmware_sha256, FirmwareFiles)
+                except Exception as ex:
+                    debugPrint(f'Deduplication check failed: {ex}')
+                _ClosePort()
+
+            # Upload firmware file
+            protocol = MarlinBinaryProtocol.Protocol(upload_port, upload_speed, upload_blocksize, float(upload_error_ratio), int(upload_timeout))
+            if upload_skip:
+                print(f"Firmware '{upload_firmware_target_name}' is already on the SD card, skipping transfer")
+                transferOK = True
+            else:
+                debugPrint(f"Copy '{upload_firmware_source_name}' --> '{upload_firmware_target_name}'")
+                #echologger = MarlinBinaryProtocol.EchoProtocol(protocol)
+                protocol.connect()
+                # Mark the rollback (delete broken transfer) from this point on
+                rollback = True
+                filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
+                transferOK = filetransfer.copy(upload_firmware_source_name, upload_firmware_target_name, upload_compression, upload_test, upload_adaptive, resume=upload_resume)
+                protocol.disconnect()
+
+                if upload_metrics:
+                    metrics_path = upload_metrics.replace('{device}', os.path.basename(upload_port))
+                    protocol.metrics.export(metrics_path, device=upload_port, env=marlin_pioenv, result='ok' if transferOK else 'failed')
+
+                # Remember what the device holds now
+                if upload_dedup:
+                    if transferOK:
+                        upload_cache.record(upload_port, upload_firmware_target_name, upload_firmware_sha256, os.path.getsize(upload_firmware_source_name))
+                    else:
+                        upload_cache.forget(upload_port, upload_firmware_target_name)
+
+                # Notify upload completed
+                protocol.send_ascii('M117 Firmware uploaded' if transferOK else 'M117 Firmware upload failed')
+
+                # Remount SD card. The client releases the card before it acknowledges the file close,
+                # and send_ascii returns on the 'ok' of M21, so there is nothing to wait for here.
+                print('Remount SD card')
+                protocol.send_ascii('M21')
+
+            # Transfer failed?
+            if not transferOK:
+                protocol.shutdown()
+                _RollbackUpload(upload_firmware_target_name)
             else:
-                print(f"Remove {len(OldFirmwareFiles)} old firmware file{'s' if len(OldFirmwareFiles) != 1 else ''}:")
-                for OldFirmwareFile in OldFirmwareFiles:
-                    print(f" -Removing- '{OldFirmwareFile}'...")
-                    print(' OK' if _RemoveFirmwareFile(OldFirmwareFile) else ' Error!')
+                # Trigger firmware update
+                if upload_reset:
+                    print('Trigger firmware update...')
+                    protocol.send_ascii('M997', True)
+                protocol.shutdown()
+
+            print('Firmware update completed' if transferOK else 'Firmware update failed')
+            return 0 if transferOK else -1
+
+        except KeyboardInterrupt:
+            print('Aborted by user')
+            if filetransfer and not upload_resume: filetransfer.abort()
+            if protocol:
+                protocol.disconnect()
+                protocol.shutdown()
+            _RollbackUpload(upload_firmware_target_name)
+            _ClosePort()
+            raise
+
+        except serial.SerialException as se:
+            # This exception is raised only for send_ascii data (not for binary transfer)
+            print(f'Serial excepion: {se}, transfer aborted')
+            if protocol:
+                protocol.disconnect()
+                protocol.shutdown()
+            _RollbackUpload(upload_firmware_target_name)
+            _ClosePort()
+            raise Exception(se)
 
-            # Close serial
+        except MarlinBinaryProtocol.FatalError:
+            print('Too many retries, transfer aborted')
+            if protocol:
+                protocol.disconnect()
+                protocol.shutdown()
+            _RollbackUpload(upload_firmware_target_name)
             _ClosePort()
+            raise
 
-            # Cleanup completed
-            debugPrint('Cleanup completed')
-
-        # WARNING! The serial port must be closed here because the serial transfer that follow needs it!
-
-        # Upload firmware file
-        debugPrint(f"Copy '{upload_firmware_source_name}' --> '{upload_firmware_target_name}'")
-        protocol = MarlinBinaryProtocol.Protocol(upload_port, upload_speed, upload_blocksize, float(upload_error_ratio), int(upload_timeout))
-        #echologger = MarlinBinaryProtocol.EchoProtocol(protocol)
-        protocol.connect()
-        # Mark the rollback (delete broken transfer) from this point on
-        rollback = True
-        filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
-        transferOK = filetransfer.copy(upload_firmware_source_name, upload_firmware_target_name, upload_compression, upload_test)
-        protocol.disconnect()
-
-        # Notify upload completed
-        protocol.send_ascii('M117 Firmware uploaded' if transferOK else 'M117 Firmware upload failed')
-
-        # Remount SD card
-        print('Wait for SD card release...')
-        time.sleep(1)
-        print('Remount SD card')
-        protocol.send_ascii('M21')
-
-        # Transfer failed?
-        if not transferOK:
-            protocol.shutdown()
+        except Exception as ex:
+            print(f"\nException: {ex}, transfer aborted")
+            if protocol:
+                protocol.disconnect()
+                protocol.shutdown()
             _RollbackUpload(upload_firmware_target_name)
-        else:
-            # Trigger firmware update
-            if upload_reset:
-                print('Trigger firmware update...')
-                protocol.send_ascii('M997', True)
-            protocol.shutdown()
-
-        print('Firmware update completed' if transferOK else 'Firmware update failed')
-        return 0 if transferOK else -1
-
-    except KeyboardInterrupt:
-        print('Aborted by user')
-        if filetransfer: filetransfer.abort()
-        if protocol:
-            protocol.disconnect()
-            protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
-        raise
-
-    except serial.SerialException as se:
-        # This exception is raised only for send_ascii data (not for binary transfer)
-        print(f'Serial excepion: {se}, transfer aborted')
-        if protocol:
-            protocol.disconnect()
-            protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
-        raise Exception(se)
-
-    except MarlinBinaryProtocol.FatalError:
-        print('Too many retries, transfer aborted')
-        if protocol:
-            protocol.disconnect()
-            protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
-        raise
-
-    except Exception as ex:
-        print(f"\nException: {ex}, transfer aborted")
-        if protocol:
-            protocol.disconnect()
-            protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
-        print('Firmware not updated')
-        raise
+            _ClosePort()
+            print('Firmware not updated')
+            raise
+
+    #-------------------#
+    # Upload to devices #
+    #-------------------#
+    if len(upload_ports) == 1:
+        return _UploadDevice(upload_ports[0], upload_firmware_target_name)
+
+    # Update all devices at once, so the fleet takes as long as the slowest device
+    from concurrent.futures import ThreadPoolExecutor
+
+    def _UploadWithRetries(upload_port):
+        start_time = time.time()
+        error = None
+        for attempt in range(upload_retries):
+            try:
+                if _UploadDevice(upload_port, upload_firmware_target_name) == 0:
+                    return (True, time.time() - start_time, None)
+                error = 'Firmware update failed'
+            except Exception as ex:
+                error = str(ex)
+            print(f"[{upload_port}] Attempt {attempt + 1} of {upload_retries} failed: {error}")
+        return (False, time.time() - start_time, error)
+
+    print(f"Uploading to {len(upload_ports)} devices: {', '.join(upload_ports)}")
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=len(upload_ports)) as executor:
+        results = dict(zip(upload_ports, executor.map(_UploadWithRetries, upload_ports)))
+
+    print('---- Upload report ----------------------------')
+    for upload_port, (ok, seconds, error) in results.items():
+        print(f" {upload_port:28}: {'OK' if ok else 'FAILED'} in {seconds:.1f}s{'' if ok else f' ({error})'}")
+    print(f" Total                       : {time.time() - start_time:.1f}s")
+    print('-----------------------------------------------')
+
+    return 0 if all(ok for ok, seconds, error in results.values()) else -1
 
 # Attach custom upload callback
 env.Replace(UPLOADCMD=Upload)